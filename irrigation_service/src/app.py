@@ -1,20 +1,24 @@
 import json
+import math
 import os
 
-import requests
 import paho.mqtt.client as mqtt
 from flask import Flask, request, jsonify
 from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity
 from dotenv import load_dotenv
-import logging
 
+from commands import CommandTracker, ACKED, PENDING
+from decision import decide_action
+from logging_config import setup_logging
+from scheduler import MAX_RUN_MINUTES, IrrigationScheduler
+from service_client import ServiceClient
 
 
 app = Flask(__name__)
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG)  # Make sure debug messages are shown
-app.logger.setLevel(logging.DEBUG)        # Set app's logger to debug
+# Background log writer; level, format and per-device sampling come from LOG_* env vars
+setup_logging("irrigation_service")
 
 
 
@@ -29,48 +33,128 @@ MQTT_USERNAME = os.getenv("MQTT_USERNAME")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 MONITORING_TOPIC = os.getenv("MONITORING_TOPIC")
 IRRIGATION_TOPIC = os.getenv("IRRIGATION_TOPIC")
+IRRIGATION_ACK_TOPIC = os.getenv("IRRIGATION_ACK_TOPIC", f"{IRRIGATION_TOPIC}/ack")
+IRRIGATION_QOS = int(os.getenv("IRRIGATION_QOS", "1"))
+IRRIGATION_ACK_TIMEOUT = float(os.getenv("IRRIGATION_ACK_TIMEOUT", "2"))
+IRRIGATION_MAX_RETRIES = int(os.getenv("IRRIGATION_MAX_RETRIES", "3"))
+IRRIGATION_RETRY_BACKOFF = float(os.getenv("IRRIGATION_RETRY_BACKOFF", "2"))
+IRRIGATION_SCHEDULE_DB = os.getenv("IRRIGATION_SCHEDULE_DB", "irrigation_schedule.db")
+ANOMALY_TOPIC = os.getenv("ANOMALY_TOPIC", "sensors/anomalies/{esp32_id}")
 USER_SERVICE_URL = os.getenv("USER_SERVICE_URL")
 API_KEY = os.getenv("API_KEY")
+USER_SERVICE_POOL_SIZE = int(os.getenv("USER_SERVICE_POOL_SIZE", "10"))
+USER_SERVICE_TIMEOUT = float(os.getenv("USER_SERVICE_TIMEOUT", "5"))
+USER_SERVICE_HEDGE_AFTER = float(os.getenv("USER_SERVICE_HEDGE_AFTER", "0.5"))
+USER_SERVICE_HEDGE_RATIO = float(os.getenv("USER_SERVICE_HEDGE_RATIO", "0.1"))
 
 # MQTT Client Setup
 client = mqtt.Client()
 client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
 client.connect(MQTT_BROKER, MQTT_PORT)
 
+# In-flight irrigation commands waiting for a device ack
+commands = CommandTracker(
+    client,
+    IRRIGATION_TOPIC,
+    qos=IRRIGATION_QOS,
+    ack_timeout=IRRIGATION_ACK_TIMEOUT,
+    max_retries=IRRIGATION_MAX_RETRIES,
+    backoff=IRRIGATION_RETRY_BACKOFF,
+)
+commands.start()
 
 
 cache = {}
 
+# Devices the monitoring service flagged as faulty; their readings are ignored
+quarantined = set()
+
 def control_irrigation(esp32_id, action):
-    """Publishes ON/OFF commands to the irrigation system."""
-    message = json.dumps({
-        "esp32_id": esp32_id,
-        "action": action  # "1" for ON, "0" for OFF
-    })
-    app.logger.debug(f"Publishing message: {message}")
-    client.publish(IRRIGATION_TOPIC, message)
+    """Publishes ON/OFF commands to the irrigation system and tracks the ack."""
+    return commands.send(esp32_id, action)  # "1" for ON, "0" for OFF
 
 
-def get_threshold_from_user_service(esp32_id):
-    """Fetches the irrigation threshold for a farm from User Management Service."""
+# Timed runs and recurring schedules, persisted across restarts
+scheduler = IrrigationScheduler(control_irrigation, IRRIGATION_SCHEDULE_DB)
+scheduler.start()
+
+
+def on_ack(mqtt_client, userdata, msg):
+    """Handles command acknowledgements sent back by the devices."""
     try:
-        url = f"{USER_SERVICE_URL}/user/farms/threshold/{esp32_id}"
-        headers = {"X-API-KEY": API_KEY}
-        response = requests.get(url, headers=headers, timeout=5)
+        payload = json.loads(msg.payload.decode())
+        if commands.handle_ack(payload) is None:
+            app.logger.debug("Ignoring ack for unknown command: %s", payload.get("command_id"))
+    except Exception as e:
+        app.logger.error(f"Error processing command ack: {e}")
+
 
-        if response.status_code == 200:
-            cache[esp32_id] = response.json()
-            return response.json()  # Return parsed threshold data
+# Pooled, non-blocking client for the User Management Service
+user_service = ServiceClient(
+    USER_SERVICE_URL,
+    headers={"X-API-KEY": API_KEY, "X-Service-Name": "irrigation_service"},
+    timeout=USER_SERVICE_TIMEOUT,
+    pool_size=USER_SERVICE_POOL_SIZE,
+    hedge_after=USER_SERVICE_HEDGE_AFTER,
+    hedge_ratio=USER_SERVICE_HEDGE_RATIO,
+)
+
+
+def get_threshold_from_user_service(esp32_id):
+    """Fetches the irrigation threshold for a farm from User Management Service.
+
+    Returns a Future; concurrent misses for the same farm share one request.
+    """
+    future = user_service.get_json(f"/user/farms/threshold/{esp32_id}")
+
+    def store(done):
+        if done.exception() is not None:
+            app.logger.error(f"Error fetching threshold from User Service: {done.exception()}")
+        elif done.result() is None:
+            app.logger.warning(f"Failed to fetch threshold for farm {esp32_id}")
         else:
-            app.logger.warning(
-                f"Failed to fetch threshold for farm {esp32_id}. "
-                f"Status: {response.status_code}, Response: {response.text}"
-            )
-            return None
+            cache[esp32_id] = done.result()
+
+    future.add_done_callback(store)
+    return future
+
+
+def apply_threshold(esp32_id, moisture, threshold):
+    """Switches irrigation based on the farm's moisture thresholds.
+
+    A timed or scheduled run takes precedence: the thresholds are not applied
+    until its OFF has fired or it was stopped, and apply again afterwards.
+    """
+    if not threshold:
+        return
+    if scheduler.has_run(esp32_id):
+        app.logger.debug("Timed run in progress, skipping threshold check", extra={"esp32_id": esp32_id})
+        return
+
+    temperature_upper_threshold = threshold.get("temperature_upper_threshold", None)
+    temperature_lower_threshold = threshold.get("temperature_lower_threshold", None)
+    moisture_upper_threshold = threshold.get("moisture_upper_threshold")
+    moisture_lower_threshold = threshold.get("moisture_lower_threshold")
+
+    # Determine irrigation action
+    action = decide_action(moisture, moisture_lower_threshold, moisture_upper_threshold)
+    if action is not None:
+        control_irrigation(esp32_id, action)
+
+
+def on_anomaly(mqtt_client, userdata, msg):
+    """Tracks which devices are quarantined by the monitoring service."""
+    try:
+        payload = json.loads(msg.payload.decode())
+        esp32_id = payload.get("esp32_id")
+        if payload.get("quarantined"):
+            quarantined.add(esp32_id)
+            app.logger.warning(f"Ignoring readings from quarantined ESP32 {esp32_id}: {payload.get('anomalies')}")
+        else:
+            quarantined.discard(esp32_id)
+    except Exception as e:
+        app.logger.error(f"Error processing anomaly message: {e}")
 
-    except requests.RequestException as e:
-        app.logger.error(f"Error fetching threshold from User Service: {e}")
-        return None
 
 def on_message(mqtt_client, userdata, msg):
     """Handles incoming sensor data and triggers irrigation if needed."""
@@ -78,29 +162,33 @@ def on_message(mqtt_client, userdata, msg):
         payload = json.loads(msg.payload.decode())
         esp32_id = payload.get("esp32_id")
         moisture = payload.get("moisture")
-        app.logger.debug(f"Received payload: {payload}")
+        app.logger.debug("Received payload: %s", payload, extra={"esp32_id": esp32_id})
+
+        if esp32_id in quarantined:
+            return
 
-        # Fetch the thresholds from User Management Service
+        # Fetch the thresholds from User Management Service without blocking the MQTT loop
         if esp32_id in cache:
-            threshold = cache[esp32_id]
+            apply_threshold(esp32_id, moisture, cache[esp32_id])
         else:
-            threshold = get_threshold_from_user_service(esp32_id)
+            future = get_threshold_from_user_service(esp32_id)
+            future.add_done_callback(
+                lambda done: apply_threshold(esp32_id, moisture, done.result()) if done.exception() is None else None
+            )
 
-        temperature_upper_threshold = threshold.get("temperature_upper_threshold", None)
-        temperature_lower_threshold = threshold.get("temperature_lower_threshold", None)
-        moisture_upper_threshold = threshold.get("moisture_upper_threshold")
-        moisture_lower_threshold = threshold.get("moisture_lower_threshold")
+    except Exception as e:
+        app.logger.error(f"Error processing MQTT message: {e}")
 
 
+def parse_flag(value):
+    """Reads a JSON or query string boolean. Returns None if it is neither."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ("true", "1", "false", "0"):
+        return value.lower() in ("true", "1")
+    return None
 
-        # Determine irrigation action
-        if moisture < moisture_lower_threshold:
-            control_irrigation(esp32_id, "1")
-        elif moisture >= moisture_upper_threshold:
-            control_irrigation(esp32_id, "0")
 
-    except Exception as e:
-        print(f"Error processing MQTT message: {e}")
 @app.route('/irrigation/toggle/<string:esp32_id>', methods=['POST'])
 @jwt_required()
 def manual_irrigation(esp32_id):
@@ -117,13 +205,117 @@ def manual_irrigation(esp32_id):
     # if action not in ["ON", "OFF"]:
     #     return jsonify({"error": "Invalid action"}), 400
 
-    control_irrigation(esp32_id, action)
-    return jsonify({"message": f"Irrigation {action} for Farm {esp32_id}"}), 200
+    # Optionally block until the device acknowledges the command
+    wait = parse_flag(data.get("wait", request.args.get("wait", False)))
+    if wait is None:
+        return jsonify({"error": "wait must be true or false"}), 400
+    timeout = data.get("timeout", request.args.get("timeout", IRRIGATION_ACK_TIMEOUT * 5))
+    try:
+        if isinstance(timeout, bool):
+            raise ValueError(timeout)
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        return jsonify({"error": "timeout must be a number of seconds"}), 400
+    if not 0 < timeout <= 60:
+        return jsonify({"error": "timeout must be between 0 and 60 seconds"}), 400
+
+    if action == "0":
+        # A manual OFF ends any timed run for this farm
+        scheduler.stop_run(esp32_id)
+    command = control_irrigation(esp32_id, action)
+
+    if wait:
+        status = command.wait(timeout)
+        if status == PENDING:
+            return jsonify({"message": "Waiting for device acknowledgement timed out",
+                            "command": command.to_dict()}), 202
+        if status != ACKED:
+            return jsonify({"error": f"Irrigation command {status}", "command": command.to_dict()}), 504
+
+    return jsonify({"message": f"Irrigation {action} for Farm {esp32_id}", "command": command.to_dict()}), 200
+
+
+@app.route('/irrigation/commands/stats', methods=['GET'])
+@jwt_required()
+def command_stats():
+    """Reports in-flight commands, retries and ack round-trip latency."""
+    return jsonify(commands.stats()), 200
+
+
+@app.route('/irrigation/run/<string:esp32_id>', methods=['POST'])
+@jwt_required()
+def timed_irrigation(esp32_id):
+    """Waters a farm for a fixed number of minutes."""
+    data = request.json or {}
+    try:
+        duration = float(data.get("duration_minutes"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "duration_minutes is required"}), 400
+    # Flask's JSON parser accepts NaN and Infinity
+    if not (math.isfinite(duration) and 0 < duration <= MAX_RUN_MINUTES):
+        return jsonify({"error": f"duration_minutes must be between 0 and {MAX_RUN_MINUTES}"}), 400
+
+    command = scheduler.run_for(esp32_id, duration)
+    return jsonify({
+        "message": f"Irrigation started for Farm {esp32_id}",
+        "run": scheduler.get_run(esp32_id),
+        "command": command.to_dict(),
+    }), 200
+
+
+@app.route('/irrigation/run/<string:esp32_id>', methods=['GET'])
+@jwt_required()
+def get_timed_irrigation(esp32_id):
+    run = scheduler.get_run(esp32_id)
+    if run is None:
+        return jsonify({"error": "No timed run in progress"}), 404
+    return jsonify(run), 200
+
+
+@app.route('/irrigation/run/<string:esp32_id>', methods=['DELETE'])
+@jwt_required()
+def stop_timed_irrigation(esp32_id):
+    """Stops a timed run early."""
+    scheduler.stop_run(esp32_id)
+    command = control_irrigation(esp32_id, "0")
+    return jsonify({"message": f"Irrigation stopped for Farm {esp32_id}", "command": command.to_dict()}), 200
+
+
+@app.route('/irrigation/schedules/<string:esp32_id>', methods=['POST'])
+@jwt_required()
+def create_schedule(esp32_id):
+    """Adds a recurring run, e.g. every day at 06:00 UTC for 15 minutes."""
+    data = request.json or {}
+    try:
+        duration = float(data.get("duration_minutes"))
+        every_hours = float(data.get("every_hours", 24))
+        schedule = scheduler.add_schedule(esp32_id, data.get("start_time", ""), duration, every_hours)
+    except (TypeError, ValueError):
+        return jsonify({"error": "start_time (HH:MM), duration_minutes and every_hours must be valid"}), 400
+    return jsonify(schedule), 201
+
+
+@app.route('/irrigation/schedules/<string:esp32_id>', methods=['GET'])
+@jwt_required()
+def list_schedules(esp32_id):
+    return jsonify({"schedules": scheduler.list_schedules(esp32_id)}), 200
+
+
+@app.route('/irrigation/schedules/<string:esp32_id>/<string:schedule_id>', methods=['DELETE'])
+@jwt_required()
+def delete_schedule(esp32_id, schedule_id):
+    if not scheduler.delete_schedule(esp32_id, schedule_id):
+        return jsonify({"error": "Schedule not found"}), 404
+    return jsonify({"message": "Schedule deleted"}), 200
 
 
 
 # Subscribe to MQTT sensor data
 client.subscribe(MONITORING_TOPIC)
+client.subscribe(IRRIGATION_ACK_TOPIC, qos=IRRIGATION_QOS)
+client.message_callback_add(IRRIGATION_ACK_TOPIC, on_ack)
+client.subscribe(ANOMALY_TOPIC.format(esp32_id="+"), qos=1)
+client.message_callback_add(ANOMALY_TOPIC.format(esp32_id="+"), on_anomaly)
 client.on_message = on_message
 client.loop_start()
 
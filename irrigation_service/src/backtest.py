@@ -0,0 +1,272 @@
+"""
+Backtest irrigation thresholds against a farm's recorded sensor history.
+
+The history is replayed through the same rule the service applies in
+``on_message`` (see ``decision.decide_action``) for every candidate
+lower/upper threshold pair at once. For each pair it reports pump-on time,
+the number of valve switches and the time the soil spent below the target
+moisture while the pump was off.
+
+The replay is open loop: it uses the recorded moisture as it was, so it
+compares how each pair would have switched the valve on that history.
+
+``on_message`` compares the raw ADC reading from the device payload with the
+thresholds, so ``raw_moisture`` is replayed by default and thresholds and
+target are in raw units. ``--field moisture`` replays the monitoring
+service's percentage instead, for thresholds on that scale.
+
+    python src/backtest.py --esp32-id esp-1 --days 365 --lower 1500:2500:50 --upper 2500:3500:100 --target 2000
+    python src/backtest.py --csv sensor_readings.csv --esp32-id esp-1 --field moisture --target 35
+
+``--csv`` takes a file from the monitoring service's ``/sensors/export``.
+Needs numpy, plus influxdb-client when reading from InfluxDB.
+"""
+import argparse
+import csv
+import itertools
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from dotenv import load_dotenv
+
+from decision import decide_action
+
+
+def load_from_influx(esp32_id, start, stop, field="raw_moisture"):
+    """Pulls one moisture field for one device from InfluxDB in a single query."""
+    from influxdb_client import Dialect, InfluxDBClient
+
+    load_dotenv()
+    client = InfluxDBClient(
+        url=os.getenv("INFLUXDB_URL"), token=os.getenv("INFLUXDB_TOKEN"), org=os.getenv("INFLUXDB_ORG")
+    )
+    query = f'''
+    from(bucket: "{os.getenv("INFLUXDB_BUCKET")}")
+      |> range(start: {start.strftime("%Y-%m-%dT%H:%M:%SZ")}, stop: {stop.strftime("%Y-%m-%dT%H:%M:%SZ")})
+      |> filter(fn: (r) => r._measurement == "sensor_readings" and r._field == "{field}")
+      |> filter(fn: (r) => r.esp32_id == "{esp32_id}")
+      |> group()
+      |> sort(columns: ["_time"])
+      |> keep(columns: ["_time", "_value"])
+    '''
+    rows = client.query_api().query_csv(query, dialect=Dialect(header=True, annotations=[]))
+    try:
+        return _collect(rows, "_time", "_value")
+    finally:
+        client.close()
+
+
+def load_from_csv(path, esp32_id=None, field="raw_moisture"):
+    """Reads a CSV export, optionally keeping a single device."""
+    with open(path, newline="") as f:
+        rows = csv.reader(f)
+        if esp32_id is not None:
+            header = next(rows)
+            device = header.index("esp32_id")
+            rows = itertools.chain([header], (row for row in rows if row[device] == esp32_id))
+        return _collect(rows, "_time", field)
+
+
+def _collect(rows, time_column, value_column):
+    """Turns CSV rows into sorted (seconds since epoch, moisture) arrays."""
+    times, values = [], []
+    header = None
+    for row in rows:
+        if not row or not any(row):
+            continue
+        if header is None or row == header:
+            header = row
+            t_index, v_index = header.index(time_column), header.index(value_column)
+            continue
+        if not row[v_index]:
+            continue
+        times.append(_timestamp(row[t_index]))
+        values.append(float(row[v_index]))
+
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float32)
+    order = np.argsort(times, kind="stable")
+    return times[order], values[order]
+
+
+def _timestamp(value):
+    """RFC3339 -> seconds since the epoch.
+
+    Export timestamps carry up to 9 fractional digits, which ``fromisoformat``
+    only accepts from Python 3.11.
+    """
+    value = value.replace("Z", "+00:00")
+    head, dot, rest = value.partition(".")
+    if not dot:
+        return datetime.fromisoformat(value).timestamp()
+    digits = len(rest) - len(rest.lstrip("0123456789"))
+    fraction, offset = rest[:digits], rest[digits:]
+    return datetime.fromisoformat(head + offset).timestamp() + int(fraction) / 10 ** len(fraction)
+
+
+def sample_durations(times, max_gap=None):
+    """How long each sample stays current, capped so outages are not counted."""
+    if len(times) < 2:
+        return np.zeros(len(times), dtype=np.float32)
+    dt = np.diff(times)
+    typical = float(np.median(dt))
+    if max_gap is None:
+        max_gap = 10 * typical
+    dt = np.append(dt, typical)
+    return np.minimum(dt, max_gap).astype(np.float32)
+
+
+def _next_index(masks):
+    """
+    For every mask and position, the first index at or after it where the mask
+    holds, or ``n`` if there is none. One extra column holds ``n`` so an index
+    of ``n`` can be looked up as well.
+    """
+    n = masks.shape[1]
+    positions = np.arange(n, dtype=np.int32)
+    index = np.full((len(masks), n + 1), n, dtype=np.int32)
+    for row, mask in zip(index, masks):
+        np.copyto(row[:n], positions, where=mask)
+        np.minimum.accumulate(row[::-1], out=row[::-1])
+    return index
+
+
+def backtest(times, moisture, lowers, uppers, target, max_gap=None):
+    """
+    Evaluates every (lower, upper) pair with lower < upper.
+
+    The valve follows ``decide_action``: closed at the start, it opens at the
+    first reading below ``lower`` and closes at the next reading at or above
+    ``upper``. For each threshold the index of the next such reading is
+    precomputed once, and prefix sums of the sample durations turn every
+    open interval into a single subtraction. All pairs then hop from switch
+    to switch together, so the cost grows with the number of valve switches
+    rather than with the number of readings.
+
+    The loop runs once per on/off cycle of the busiest pair. A year of clean
+    data takes well under a second, but a noisy series hovering around a
+    threshold can switch hundreds of thousands of times and take several
+    seconds. ``main`` reports the cycle count; smooth the input or drop
+    pairs with narrow bands if that gets too slow.
+    """
+    lowers = np.asarray(sorted(set(lowers)), dtype=np.float32)
+    uppers = np.asarray(sorted(set(uppers)), dtype=np.float32)
+    lower_index, upper_index = np.meshgrid(np.arange(len(lowers)), np.arange(len(uppers)), indexing="ij")
+    valid = lowers[lower_index] < uppers[upper_index]
+    lower_index, upper_index = lower_index[valid], upper_index[valid]
+    if not len(lower_index):
+        raise ValueError("No candidate pairs with lower < upper")
+
+    moisture = np.asarray(moisture, dtype=np.float32)
+    n = len(moisture)
+    dt = sample_durations(times, max_gap).astype(np.float64)
+    elapsed = np.concatenate(([0.0], np.cumsum(dt)))
+    dry = np.concatenate(([0.0], np.cumsum(np.where(moisture < target, dt, 0.0))))
+
+    next_start = _next_index(moisture < lowers[:, None])   # decide_action -> "1"
+    next_stop = _next_index(moisture >= uppers[:, None])   # decide_action -> "0"
+
+    candidates = len(lower_index)
+    pump_on = np.zeros(candidates)
+    dry_on = np.zeros(candidates)
+    switches = np.zeros(candidates, dtype=np.int64)
+
+    active = np.arange(candidates)
+    position = np.zeros(candidates, dtype=np.int32)
+    cycles = 0
+    while len(active):
+        cycles += 1
+        on_at = next_start[lower_index[active], position]
+        off_at = next_stop[upper_index[active], on_at]
+        pump_on[active] += elapsed[off_at] - elapsed[on_at]
+        dry_on[active] += dry[off_at] - dry[on_at]
+        switches[active] += (on_at < n).astype(np.int64) + (off_at < n)
+
+        more = off_at < n
+        active, position = active[more], off_at[more]
+
+    return {
+        "moisture_lower_threshold": lowers[lower_index],
+        "moisture_upper_threshold": uppers[upper_index],
+        "pump_on_hours": pump_on / 3600,
+        "switches": switches,
+        "hours_below_target": (dry[-1] - dry_on) / 3600,
+        "cycles": cycles,
+    }
+
+
+def replay(times, moisture, lower, upper, target, max_gap=None):
+    """Sample-by-sample replay of one pair through ``decide_action``, for spot checks."""
+    dt = sample_durations(times, max_gap)
+    on = False
+    pump_on = dry_off = 0.0
+    switches = 0
+    for value, duration in zip(moisture.tolist(), dt.tolist()):
+        action = decide_action(value, lower, upper)
+        if action is not None and (action == "1") != on:
+            on = action == "1"
+            switches += 1
+        if on:
+            pump_on += duration
+        elif value < target:
+            dry_off += duration
+    return {"pump_on_hours": pump_on / 3600, "switches": switches, "hours_below_target": dry_off / 3600}
+
+
+def parse_range(value):
+    """'20:40:2' -> 20, 22, ..., 40 and '20,30,35' -> 20, 30, 35."""
+    if ":" in value:
+        start, stop, step = (float(part) for part in value.split(":"))
+        return np.arange(start, stop + step / 2, step).tolist()
+    return [float(part) for part in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest irrigation moisture thresholds on sensor history")
+    parser.add_argument("--esp32-id", help="Device to replay (required unless the CSV holds one device)")
+    parser.add_argument("--csv", help="Read history from a /sensors/export CSV instead of InfluxDB")
+    parser.add_argument("--days", type=float, default=365, help="History to pull from InfluxDB")
+    parser.add_argument("--field", default="raw_moisture", choices=("raw_moisture", "moisture"),
+                        help="raw_moisture is what the service compares with the thresholds")
+    parser.add_argument("--lower", required=True, help="Lower thresholds, start:stop:step or a list")
+    parser.add_argument("--upper", required=True, help="Upper thresholds, start:stop:step or a list")
+    parser.add_argument("--target", type=float, required=True, help="Moisture the crop should stay above")
+    parser.add_argument("--max-gap", type=float, help="Longest gap in seconds a sample is held for")
+    parser.add_argument("--sort-by", default="hours_below_target",
+                        choices=("hours_below_target", "pump_on_hours", "switches"))
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.csv:
+        times, moisture = load_from_csv(args.csv, args.esp32_id, args.field)
+    else:
+        if not args.esp32_id:
+            parser.error("--esp32-id is required when reading from InfluxDB")
+        stop = datetime.now(timezone.utc)
+        times, moisture = load_from_influx(args.esp32_id, stop - timedelta(days=args.days), stop, args.field)
+    if not len(times):
+        parser.error("No sensor history found")
+
+    started = time.perf_counter()
+    results = backtest(times, moisture, parse_range(args.lower), parse_range(args.upper), args.target,
+                       args.max_gap)
+    elapsed = time.perf_counter() - started
+
+    span = times[-1] - times[0]
+    candidates = len(results["switches"])
+    print(f"Replayed {len(times)} {args.field} readings ({span / 86400:.1f} days) x {candidates} threshold pairs "
+          f"in {elapsed:.3f}s ({span * candidates / max(elapsed, 1e-9):,.0f}x real time, "
+          f"{results['cycles']} valve cycles)")
+
+    order = np.lexsort((results["switches"], results["pump_on_hours"], results[args.sort_by]))
+    print(f"{'lower':>6} {'upper':>6} {'pump on h':>10} {'switches':>9} {'dry h':>8}")
+    for i in order[:args.top]:
+        print(f"{results['moisture_lower_threshold'][i]:6g} {results['moisture_upper_threshold'][i]:6g} "
+              f"{results['pump_on_hours'][i]:10.1f} {results['switches'][i]:9d} "
+              f"{results['hours_below_target'][i]:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import heapq
+import itertools
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+PENDING = "pending"
+ACKED = "acked"
+FAILED = "failed"
+SUPERSEDED = "superseded"
+
+
+class Command:
+    """A single irrigation command waiting for a device acknowledgement."""
+
+    __slots__ = (
+        "command_id", "esp32_id", "action", "attempts", "status",
+        "created_at", "sent_at", "acked_at", "deadline", "done",
+    )
+
+    def __init__(self, esp32_id, action):
+        self.command_id = uuid.uuid4().hex
+        self.esp32_id = esp32_id
+        self.action = action
+        self.attempts = 0
+        self.status = PENDING
+        self.created_at = time.monotonic()
+        self.sent_at = None
+        self.acked_at = None
+        self.deadline = None
+        self.done = threading.Event()
+
+    @property
+    def latency(self):
+        """Round trip from the first publish to the ack, in seconds."""
+        if self.acked_at is None:
+            return None
+        return self.acked_at - self.created_at
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.status
+
+    def to_dict(self):
+        latency = self.latency
+        return {
+            "command_id": self.command_id,
+            "esp32_id": self.esp32_id,
+            "action": self.action,
+            "status": self.status,
+            "attempts": self.attempts,
+            "latency_ms": round(latency * 1000, 1) if latency is not None else None,
+        }
+
+
+class CommandTracker:
+    """
+    Keeps the table of in-flight irrigation commands.
+
+    Every command gets an id and is published with the configured QoS.
+    Devices answer on the ack topic with the same id. Commands that are not
+    acknowledged in time are republished with exponential backoff until
+    ``max_retries`` is used up. There is at most one pending command per
+    device: a newer command replaces the pending one, and repeating the
+    pending action does not publish again.
+    """
+
+    def __init__(self, mqtt_client, topic, qos=1, ack_timeout=2.0,
+                 max_retries=3, backoff=2.0, latency_window=1000):
+        self.mqtt_client = mqtt_client
+        self.topic = topic
+        self.qos = qos
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._pending = {}   # esp32_id -> Command
+        self._by_id = {}     # command_id -> Command
+        self._deadlines = []  # heap of (deadline, seq, command_id)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._latencies = deque(maxlen=latency_window)
+        self._counters = {"sent": 0, "acked": 0, "retried": 0, "failed": 0, "coalesced": 0}
+        self._outbox = deque()  # messages waiting to be handed to the MQTT client, in order
+        self._flushing = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._retry_loop, name="irrigation-commands", daemon=True)
+            self._thread.start()
+
+    def send(self, esp32_id, action):
+        """Queues a command for a device and returns the tracked Command."""
+        with self._lock:
+            current = self._pending.get(esp32_id)
+            if current is not None:
+                if current.action == action:
+                    self._counters["coalesced"] += 1
+                    return current
+                self._finish(current, SUPERSEDED)
+
+            command = Command(esp32_id, action)
+            self._pending[esp32_id] = command
+            self._by_id[command.command_id] = command
+            self._publish(command)
+            self._wakeup.notify()
+        self._flush()
+        return command
+
+    def handle_ack(self, payload):
+        """Marks the command referenced by an ack payload as acknowledged."""
+        command_id = payload.get("command_id")
+        with self._lock:
+            command = self._by_id.get(command_id)
+            if command is None or command.status != PENDING:
+                return None
+            command.acked_at = time.monotonic()
+            self._latencies.append(command.latency)
+            self._counters["acked"] += 1
+            self._finish(command, ACKED)
+        logger.debug("Command %s acked by %s in %.1f ms",
+                     command_id, command.esp32_id, command.latency * 1000,
+                     extra={"esp32_id": command.esp32_id})
+        return command
+
+    def get(self, command_id):
+        with self._lock:
+            return self._by_id.get(command_id)
+
+    def stats(self):
+        """Returns counters and round trip latency percentiles in milliseconds."""
+        with self._lock:
+            samples = sorted(self._latencies)
+            stats = dict(self._counters, in_flight=len(self._pending))
+
+        if samples:
+            def pct(p):
+                return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 1)
+            stats["latency_ms"] = {
+                "count": len(samples),
+                "avg": round(sum(samples) / len(samples) * 1000, 1),
+                "p50": pct(0.50),
+                "p95": pct(0.95),
+                "p99": pct(0.99),
+                "max": round(samples[-1] * 1000, 1),
+            }
+        else:
+            stats["latency_ms"] = None
+        return stats
+
+    def _publish(self, command):
+        """Queues a command for publishing and schedules its ack deadline. Caller holds the lock."""
+        message = json.dumps({
+            "command_id": command.command_id,
+            "esp32_id": command.esp32_id,
+            "action": command.action,  # "1" for ON, "0" for OFF
+        })
+        command.attempts += 1
+        command.sent_at = time.monotonic()
+        command.deadline = command.sent_at + self.ack_timeout * (self.backoff ** (command.attempts - 1))
+        heapq.heappush(self._deadlines, (command.deadline, next(self._seq), command.command_id))
+        self._counters["sent"] += 1
+        logger.debug("Publishing command %s (attempt %d): %s", command.command_id, command.attempts, message,
+                     extra={"esp32_id": command.esp32_id})
+        self._outbox.append((command, command.attempts, message))
+
+    def _flush(self):
+        """
+        Hands queued messages to the MQTT client. Caller must not hold the lock.
+
+        paho's publish takes the client's callback mutex, which the network
+        thread holds while on_ack/on_message call back into the tracker, so
+        publishing under our lock could deadlock. Only one thread drains the
+        outbox at a time, which keeps messages in the order they were queued.
+        Commands that were replaced while waiting are not published at all.
+        """
+        with self._lock:
+            if self._flushing:
+                return
+            self._flushing = True
+        try:
+            while True:
+                with self._lock:
+                    if not self._outbox:
+                        self._flushing = False
+                        return
+                    command, attempt, message = self._outbox.popleft()
+                    # Replaced or already queued again before it went out
+                    if command.status != PENDING or command.attempts != attempt:
+                        continue
+                self.mqtt_client.publish(self.topic, message, qos=self.qos)
+        except BaseException:
+            with self._lock:
+                self._flushing = False
+            raise
+
+    def _finish(self, command, status):
+        """Removes a command from the in-flight table. Caller holds the lock."""
+        command.status = status
+        self._by_id.pop(command.command_id, None)
+        if self._pending.get(command.esp32_id) is command:
+            del self._pending[command.esp32_id]
+        command.done.set()
+
+    def _retry_loop(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    deadline, _, command_id = heapq.heappop(self._deadlines)
+                    command = self._by_id.get(command_id)
+                    # Skip entries left behind by acked, replaced or republished commands
+                    if command is None or command.deadline != deadline:
+                        continue
+                    if command.attempts > self.max_retries:
+                        self._counters["failed"] += 1
+                        self._finish(command, FAILED)
+                        logger.warning("Command %s for %s was not acknowledged after %d attempts",
+                                       command_id, command.esp32_id, command.attempts)
+                    else:
+                        self._counters["retried"] += 1
+                        self._publish(command)
+
+                if not self._outbox:
+                    timeout = self._deadlines[0][0] - now if self._deadlines else None
+                    self._wakeup.wait(timeout)
+            self._flush()
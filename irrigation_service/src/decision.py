@@ -0,0 +1,12 @@
+def decide_action(moisture, moisture_lower_threshold, moisture_upper_threshold):
+    """
+    Irrigation rule shared by the live service and the backtest.
+
+    Returns "1" to start irrigation, "0" to stop it, or None to leave the
+    valve as it is. Between the thresholds the valve keeps its last state.
+    """
+    if moisture < moisture_lower_threshold:
+        return "1"
+    if moisture >= moisture_upper_threshold:
+        return "0"
+    return None
@@ -0,0 +1,282 @@
+import math
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+
+from timer_wheel import TimerWheel
+
+
+logger = getLogger(__name__)
+
+
+RUN_OFF = "off"
+SCHEDULE_START = "start"
+
+MAX_RUN_MINUTES = 24 * 60
+MAX_EVERY_HOURS = 24 * 365
+
+
+class IrrigationScheduler:
+    """
+    Timed irrigation runs and recurring schedules.
+
+    Pending timers live in a hierarchical timer wheel driven by its own
+    thread, so a scheduled OFF fires even when no sensor message arrives.
+    Every timer and schedule is also written to a small SQLite database and
+    reloaded on start, so runs survive a restart. Overdue OFFs fire straight
+    away on reload; missed schedule starts are skipped to the next occurrence.
+    """
+
+    def __init__(self, control_irrigation, db_path, tick_seconds=1.0):
+        self.control_irrigation = control_irrigation
+        self.tick_seconds = tick_seconds
+        self.wheel = TimerWheel(start_tick=self._to_tick(time.time()))
+        self._runs = {}  # esp32_id -> timer id of the pending OFF
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS timers (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                esp32_id TEXT NOT NULL,
+                fire_at REAL NOT NULL,
+                schedule_id TEXT
+            );
+            CREATE TABLE IF NOT EXISTS schedules (
+                id TEXT PRIMARY KEY,
+                esp32_id TEXT NOT NULL,
+                start_time TEXT NOT NULL,
+                duration_minutes REAL NOT NULL,
+                every_hours REAL NOT NULL,
+                anchor REAL
+            );
+            CREATE INDEX IF NOT EXISTS schedules_esp32_id ON schedules (esp32_id);
+        """)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(schedules)")}
+        if "anchor" not in columns:
+            # Schedules created before the grid anchor was stored get one on load
+            self.db.execute("ALTER TABLE schedules ADD COLUMN anchor REAL")
+        self.db.commit()
+
+    def start(self):
+        self._load()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="irrigation-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    # Timed runs
+
+    def run_for(self, esp32_id, duration_minutes):
+        """Turns irrigation on now and schedules the OFF after ``duration_minutes``.
+
+        Replaces any pending timed run for the device and returns the ON command.
+        """
+        _check_duration(duration_minutes)
+        fire_at = time.time() + duration_minutes * 60
+        with self._lock:
+            self._cancel_run(esp32_id)
+            timer_id = uuid.uuid4().hex
+            self._add_timer(timer_id, RUN_OFF, esp32_id, fire_at)
+            self._runs[esp32_id] = timer_id
+            self.db.commit()
+        return self.control_irrigation(esp32_id, "1")
+
+    def stop_run(self, esp32_id):
+        """Cancels a pending timed run. Returns False if there was none."""
+        with self._lock:
+            cancelled = self._cancel_run(esp32_id)
+            self.db.commit()
+        return cancelled
+
+    def has_run(self, esp32_id):
+        """True while a timed run for the device is waiting for its OFF."""
+        with self._lock:
+            return esp32_id in self._runs
+
+    def get_run(self, esp32_id):
+        with self._lock:
+            timer = self.wheel.get(self._runs.get(esp32_id))
+            if timer is None:
+                return None
+            return {"esp32_id": esp32_id, "off_at": _isoformat(timer.payload["fire_at"])}
+
+    # Recurring schedules
+
+    def add_schedule(self, esp32_id, start_time, duration_minutes, every_hours=24):
+        """Adds a recurring run starting at ``start_time`` (HH:MM, UTC).
+
+        Runs are ``every_hours`` apart on a grid anchored at ``start_time`` on
+        the day the schedule is created, so periods that do not divide a day
+        stay evenly spaced across midnight.
+        """
+        _check_duration(duration_minutes)
+        if not (math.isfinite(every_hours) and 0 < every_hours <= MAX_EVERY_HOURS):
+            raise ValueError(f"every_hours must be between 0 and {MAX_EVERY_HOURS}")
+        now = time.time()
+        anchor = _grid_anchor(start_time, now)
+        first = _next_occurrence(anchor, every_hours, now)
+        schedule_id = uuid.uuid4().hex
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO schedules (id, esp32_id, start_time, duration_minutes, every_hours, anchor) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (schedule_id, esp32_id, start_time, duration_minutes, every_hours, anchor),
+            )
+            self._add_timer(schedule_id, SCHEDULE_START, esp32_id, first, schedule_id)
+            self.db.commit()
+        return self._schedule_dict(schedule_id, esp32_id, start_time, duration_minutes, every_hours, first)
+
+    def delete_schedule(self, esp32_id, schedule_id):
+        """Deletes one of the device's schedules. Returns False if it has no such schedule."""
+        with self._lock:
+            deleted = self.db.execute(
+                "DELETE FROM schedules WHERE id = ? AND esp32_id = ?", (schedule_id, esp32_id)
+            ).rowcount
+            if deleted:
+                self.wheel.cancel(schedule_id)
+                self.db.execute("DELETE FROM timers WHERE id = ?", (schedule_id,))
+            self.db.commit()
+        return bool(deleted)
+
+    def list_schedules(self, esp32_id):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id, esp32_id, start_time, duration_minutes, every_hours "
+                "FROM schedules WHERE esp32_id = ?", (esp32_id,)
+            ).fetchall()
+            schedules = []
+            for row in rows:
+                timer = self.wheel.get(row[0])
+                next_run = timer.payload["fire_at"] if timer else None
+                schedules.append(self._schedule_dict(*row, next_run))
+        return schedules
+
+    # Internals
+
+    def _to_tick(self, timestamp):
+        return int(timestamp / self.tick_seconds)
+
+    def _add_timer(self, timer_id, kind, esp32_id, fire_at, schedule_id=None, persist=True):
+        """Caller holds the lock and commits."""
+        payload = {"kind": kind, "esp32_id": esp32_id, "fire_at": fire_at, "schedule_id": schedule_id}
+        # Round up so a timer never fires before its due time
+        self.wheel.add(timer_id, -int(-fire_at // self.tick_seconds), payload)
+        if persist:
+            self.db.execute(
+                "INSERT OR REPLACE INTO timers (id, kind, esp32_id, fire_at, schedule_id) VALUES (?, ?, ?, ?, ?)",
+                (timer_id, kind, esp32_id, fire_at, schedule_id),
+            )
+
+    def _cancel_run(self, esp32_id):
+        """Caller holds the lock and commits."""
+        timer_id = self._runs.pop(esp32_id, None)
+        if timer_id is None:
+            return False
+        self.wheel.cancel(timer_id)
+        self.db.execute("DELETE FROM timers WHERE id = ?", (timer_id,))
+        return True
+
+    def _load(self):
+        now = time.time()
+        with self._lock:
+            for timer_id, kind, esp32_id, fire_at, schedule_id in self.db.execute(
+                "SELECT id, kind, esp32_id, fire_at, schedule_id FROM timers"
+            ).fetchall():
+                if kind == RUN_OFF:
+                    self._add_timer(timer_id, kind, esp32_id, fire_at, persist=False)
+                    self._runs[esp32_id] = timer_id
+
+            for schedule_id, esp32_id, start_time, every_hours, anchor in self.db.execute(
+                "SELECT id, esp32_id, start_time, every_hours, anchor FROM schedules"
+            ).fetchall():
+                if anchor is None:
+                    anchor = _grid_anchor(start_time, now)
+                    self.db.execute("UPDATE schedules SET anchor = ? WHERE id = ?", (anchor, schedule_id))
+                fire_at = _next_occurrence(anchor, every_hours, now)
+                self._add_timer(schedule_id, SCHEDULE_START, esp32_id, fire_at, schedule_id)
+            self.db.commit()
+        logger.info("Loaded %d irrigation timers", len(self.wheel))
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                expired = self.wheel.advance(self._to_tick(time.time()))
+            for timer in expired:
+                try:
+                    self._fire(timer)
+                except Exception as e:
+                    logger.error(f"Error firing irrigation timer {timer.timer_id}: {e}")
+            self._stop.wait(self.tick_seconds - time.time() % self.tick_seconds)
+
+    def _fire(self, timer):
+        payload = timer.payload
+        esp32_id = payload["esp32_id"]
+
+        if payload["kind"] == RUN_OFF:
+            with self._lock:
+                if self._runs.get(esp32_id) == timer.timer_id:
+                    del self._runs[esp32_id]
+                self.db.execute("DELETE FROM timers WHERE id = ?", (timer.timer_id,))
+                self.db.commit()
+            logger.info("Timed run finished for %s", esp32_id)
+            self.control_irrigation(esp32_id, "0")
+            return
+
+        with self._lock:
+            row = self.db.execute(
+                "SELECT duration_minutes, every_hours, anchor FROM schedules WHERE id = ?",
+                (payload["schedule_id"],),
+            ).fetchone()
+            if row is None:
+                return
+            duration_minutes, every_hours, anchor = row
+            fire_at = _next_occurrence(anchor, every_hours, payload["fire_at"] + 1)
+            self._add_timer(timer.timer_id, SCHEDULE_START, esp32_id, fire_at, timer.timer_id)
+            self.db.commit()
+        logger.info("Starting scheduled run %s for %s", timer.timer_id, esp32_id)
+        self.run_for(esp32_id, duration_minutes)
+
+    @staticmethod
+    def _schedule_dict(schedule_id, esp32_id, start_time, duration_minutes, every_hours, next_run):
+        return {
+            "schedule_id": schedule_id,
+            "esp32_id": esp32_id,
+            "start_time": start_time,
+            "duration_minutes": duration_minutes,
+            "every_hours": every_hours,
+            "next_run": _isoformat(next_run) if next_run is not None else None,
+        }
+
+
+def _check_duration(duration_minutes):
+    # NaN and huge values would otherwise fail only after a pending OFF was cancelled
+    if not (math.isfinite(duration_minutes) and 0 < duration_minutes <= MAX_RUN_MINUTES):
+        raise ValueError(f"duration_minutes must be between 0 and {MAX_RUN_MINUTES}")
+
+
+def _grid_anchor(start_time, now):
+    """Timestamp of ``start_time`` (HH:MM, UTC) on the day of ``now``."""
+    hours, minutes = (int(part) for part in start_time.split(":"))
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError("start_time must be HH:MM")
+    day = datetime.fromtimestamp(now, tz=timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (day + timedelta(hours=hours, minutes=minutes)).timestamp()
+
+
+def _next_occurrence(anchor, every_hours, after):
+    """First time at or after ``after`` on the grid of ``every_hours`` through ``anchor``."""
+    period = every_hours * 3600
+    return anchor + -(-(after - anchor) // period) * period
+
+
+def _isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
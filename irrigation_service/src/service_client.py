@@ -0,0 +1,248 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from logging import getLogger
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service that keeps failing."""
+
+
+class RetryLaterError(requests.HTTPError):
+    """The service asked for a break (429, or 503 with Retry-After)."""
+
+    def __init__(self, retry_after, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after ``failure_threshold`` consecutive failures. While open,
+    calls are rejected right away. After ``reset_timeout`` seconds one trial
+    call is let through (half open); its outcome closes or reopens the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def healthy(self):
+        """True while closed with no failures since the last success."""
+        with self._lock:
+            return self.state == self.CLOSED and self._failures == 0
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Circuit opened after %d failures", self._failures)
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class ServiceClient:
+    """
+    Shared HTTP client for calls to another service.
+
+    - one keep-alive ``requests.Session`` with a bounded connection pool
+    - concurrent requests for the same path share a single in-flight request
+    - a circuit breaker so a failing service is not hammered
+    - hedged retries: if an attempt is slow, a second one is started and the
+      first successful answer wins; failed attempts are retried with backoff
+    - hedges are limited to ``hedge_ratio`` of recent requests and are not
+      sent at all while the breaker has seen failures, so a slow service does
+      not get extra load
+    - 429 and 503 with ``Retry-After`` stop all calls to the service until
+      that time has passed; requests made meanwhile fail with ``RetryLaterError``
+
+    ``get_json`` returns a ``concurrent.futures.Future`` so callers such as MQTT
+    callbacks never block on the network.
+    """
+
+    def __init__(self, base_url, headers=None, timeout=5.0, pool_size=10, hedge_after=0.5,
+                 hedge_ratio=0.1, max_attempts=3, retry_backoff=0.2, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.hedge_ratio = hedge_ratio
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Separate pools: a request waits on its own attempts, so they must not share workers
+        self._requests = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="service-request")
+        self._attempts = ThreadPoolExecutor(max_workers=pool_size * 2, thread_name_prefix="service-attempt")
+        self._in_flight = {}
+        self._lock = threading.RLock()  # done callbacks may run inline under the lock
+        self._hedge_tokens = 0.0  # each request earns hedge_ratio, each hedge spends 1
+        self._retry_at = 0.0      # monotonic time before which the service asked not to be called
+
+    def get_json(self, path):
+        """Returns a Future resolving to the decoded JSON body, or None on 404."""
+        with self._lock:
+            future = self._in_flight.get(path)
+            if future is None:
+                future = self._requests.submit(self._get_with_retries, path)
+                self._in_flight[path] = future
+                future.add_done_callback(lambda done, path=path: self._forget(path, done))
+        return future
+
+    def get(self, path, timeout=None):
+        """Blocking variant of ``get_json``."""
+        return self.get_json(path).result(timeout)
+
+    def close(self):
+        self._requests.shutdown(wait=False)
+        self._attempts.shutdown(wait=False)
+        self.session.close()
+
+    def _forget(self, path, future):
+        with self._lock:
+            if self._in_flight.get(path) is future:
+                del self._in_flight[path]
+
+    def _get_with_retries(self, path):
+        error = None
+        for attempt in range(self.max_attempts):
+            with self._lock:
+                wait_for = self._retry_at - time.monotonic()
+            if wait_for > 0:
+                raise RetryLaterError(wait_for, f"{self.base_url} asked to retry in {wait_for:.1f}s")
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"Circuit open for {self.base_url}")
+            try:
+                result = self._get_hedged(path)
+            except RetryLaterError as e:
+                # 429 means the service is up; 503 counts against it. Either way, do not retry now
+                if e.response is not None and e.response.status_code == 429:
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+                with self._lock:
+                    self._retry_at = max(self._retry_at, time.monotonic() + e.retry_after)
+                logger.warning("%s asked to back off for %.1fs", self.base_url, e.retry_after)
+                raise
+            except requests.RequestException as e:
+                self.breaker.record_failure()
+                error = e
+                if attempt + 1 < self.max_attempts:
+                    time.sleep(self.retry_backoff * (2 ** attempt))
+                continue
+            self.breaker.record_success()
+            return result
+        raise error
+
+    def _get_hedged(self, path):
+        with self._lock:
+            self._hedge_tokens = min(self._hedge_tokens + self.hedge_ratio, 10.0)
+        attempts = [self._attempts.submit(self._get_once, path)]
+        done, _ = wait(attempts, timeout=self.hedge_after)
+        if not done and self._take_hedge():
+            attempts.append(self._attempts.submit(self._get_once, path))
+
+        error = None
+        pending = set(attempts)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except requests.RequestException as e:
+                    error = e
+        raise error
+
+    def _take_hedge(self):
+        if not self.breaker.healthy():
+            return False
+        with self._lock:
+            if self._hedge_tokens < 1:
+                return False
+            self._hedge_tokens -= 1
+            return True
+
+    def _get_once(self, path):
+        response = self.session.get(f"{self.base_url}{path}", timeout=self.timeout)
+        if response.status_code == 404:
+            return None
+        if response.status_code in (429, 503):
+            retry_after = _retry_after(response)
+            if retry_after is not None or response.status_code == 429:
+                retry_after = 1.0 if retry_after is None else retry_after
+                raise RetryLaterError(retry_after, f"{response.status_code} from {response.url}",
+                                      response=response)
+        if response.status_code >= 500:
+            raise requests.HTTPError(f"{response.status_code} from {response.url}", response=response)
+        if response.status_code != 200:
+            logger.warning("Unexpected status %s from %s: %s", response.status_code, response.url, response.text)
+            return None
+        return response.json()
+
+
+def _retry_after(response):
+    """Seconds from a Retry-After header (delay or HTTP date), or None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class AsyncServiceClient:
+    """
+    asyncio front end for ``ServiceClient``.
+
+    Requests still run on the shared session and its worker threads, so
+    coroutines and threaded callers share the same connection pool, the same
+    in-flight requests and the same circuit breaker.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def get_json(self, path):
+        return await asyncio.wrap_future(self.client.get_json(path))
@@ -0,0 +1,111 @@
+class Timer:
+    """A pending timer. ``expires`` is expressed in wheel ticks."""
+
+    __slots__ = ("timer_id", "expires", "payload", "level", "slot")
+
+    def __init__(self, timer_id, expires, payload):
+        self.timer_id = timer_id
+        self.expires = expires
+        self.payload = payload
+        self.level = None
+        self.slot = None
+
+
+class TimerWheel:
+    """
+    Hierarchical timing wheel (Varghese & Lauck).
+
+    Level 0 has one slot per tick, and every level above it covers ``slots``
+    times the range of the level below. Timers are kept in per-slot dicts, so
+    adding and cancelling are O(1). When the lower level wraps, the matching
+    slot of the level above is cascaded down. Timers further out than the top
+    level are parked in its last slot and re-placed when it cascades.
+
+    The wheel is not thread safe. Callers serialize access to it.
+    """
+
+    def __init__(self, start_tick=0, slot_bits=6, levels=4):
+        self.slot_bits = slot_bits
+        self.slots = 1 << slot_bits
+        self.mask = self.slots - 1
+        self.levels = levels
+        self.current_tick = start_tick
+        self._wheels = [[{} for _ in range(self.slots)] for _ in range(levels)]
+        self._timers = {}
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, timer_id):
+        return timer_id in self._timers
+
+    def add(self, timer_id, expires, payload=None):
+        """Adds a timer. Timers already due fire on the next tick."""
+        if timer_id in self._timers:
+            self.cancel(timer_id)
+        timer = Timer(timer_id, max(expires, self.current_tick + 1), payload)
+        self._timers[timer_id] = timer
+        self._place(timer)
+        return timer
+
+    def cancel(self, timer_id):
+        """Removes a pending timer and returns it, or None if it is unknown."""
+        timer = self._timers.pop(timer_id, None)
+        if timer is not None:
+            del self._wheels[timer.level][timer.slot][timer_id]
+        return timer
+
+    def get(self, timer_id):
+        return self._timers.get(timer_id)
+
+    def advance(self, tick):
+        """Moves the wheel forward to ``tick`` and returns the expired timers."""
+        expired = []
+        while self.current_tick < tick:
+            if not self._timers:
+                # Nothing can fire, skip straight to the target tick
+                self.current_tick = tick
+                break
+            self.current_tick += 1
+            self._cascade()
+            bucket = self._wheels[0][self.current_tick & self.mask]
+            if bucket:
+                self._wheels[0][self.current_tick & self.mask] = {}
+                for timer in bucket.values():
+                    del self._timers[timer.timer_id]
+                    expired.append(timer)
+        return expired
+
+    def _place(self, timer):
+        delta = timer.expires - self.current_tick
+        for level in range(self.levels):
+            if delta < 1 << (self.slot_bits * (level + 1)):
+                break
+        else:
+            # Beyond the wheel's horizon: park in the farthest top-level slot
+            level = self.levels - 1
+            shift = self.slot_bits * level
+            slot = ((self.current_tick >> shift) - 1) & self.mask
+            timer.level, timer.slot = level, slot
+            self._wheels[level][slot][timer.timer_id] = timer
+            return
+
+        slot = (timer.expires >> (self.slot_bits * level)) & self.mask
+        timer.level, timer.slot = level, slot
+        self._wheels[level][slot][timer.timer_id] = timer
+
+    def _cascade(self):
+        # Find the highest level whose lower levels all wrapped on this tick,
+        # then redistribute from the top down so timers land in the right slots
+        top = 0
+        for level in range(1, self.levels):
+            if self.current_tick & ((1 << (self.slot_bits * level)) - 1):
+                break
+            top = level
+        for level in range(top, 0, -1):
+            slot = (self.current_tick >> (self.slot_bits * level)) & self.mask
+            bucket = self._wheels[level][slot]
+            if bucket:
+                self._wheels[level][slot] = {}
+                for timer in bucket.values():
+                    self._place(timer)
@@ -0,0 +1,158 @@
+import math
+from array import array
+
+
+RAW_MOISTURE = 0
+TEMPERATURE = 1
+METRICS = ("raw_moisture", "temperature")
+
+
+class AnomalyDetector:
+    """
+    Streaming per-device anomaly detection.
+
+    Statistics are kept incrementally for every ``esp32_id`` in flat arrays,
+    one column per statistic and one row per device, which costs about 60
+    bytes per device on top of the id lookup:
+
+    - Welford running mean and variance, used for the spread of a metric
+    - an EWMA that tracks the current level, since moisture moves with watering
+    - the last value and how many times in a row it has repeated
+
+    Each reading is checked for values pinned at the ADC limits, temperatures
+    outside the plausible range, stuck values and spikes away from the EWMA.
+    Suspect readings are not folded into the spread. Every check is O(1).
+
+    A steady temperature is normal, so stuck detection for temperature has its
+    own run length and is off unless ``temperature_stuck_run`` is set.
+
+    A device is quarantined after ``quarantine_after`` anomalous readings in a
+    row and released after ``release_after`` clean ones. The readings that
+    lead up to quarantine are not blocked, so only sustained faults are kept
+    away from irrigation.
+    """
+
+    def __init__(self, raw_min=0, raw_max=4095, temperature_min=-20.0, temperature_max=60.0,
+                 alpha=0.1, z_threshold=4.0, warmup=30, stuck_run=30, temperature_stuck_run=0,
+                 quarantine_after=3, release_after=3):
+        self.raw_min = raw_min
+        self.raw_max = raw_max
+        self.temperature_min = temperature_min
+        self.temperature_max = temperature_max
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.warmup = warmup
+        self.stuck_runs = (stuck_run, temperature_stuck_run)  # per metric, 0 = off
+        self.quarantine_after = quarantine_after
+        self.release_after = release_after
+
+        self._index = {}  # esp32_id -> row
+        self._quarantined = array("B")
+        self._streak = array("H")  # readings in a row that point away from the current state
+        self._count = [array("I"), array("I")]
+        self._mean = [array("d"), array("d")]
+        self._m2 = [array("d"), array("d")]
+        self._ewma = [array("f"), array("f")]
+        self._last = [array("f"), array("f")]
+        self._run = [array("H"), array("H")]
+
+    def __len__(self):
+        return len(self._index)
+
+    def is_quarantined(self, esp32_id):
+        row = self._index.get(esp32_id)
+        return row is not None and bool(self._quarantined[row])
+
+    def observe(self, esp32_id, raw_moisture, temperature):
+        """
+        Checks a reading and updates the device statistics.
+
+        Returns ``(anomalies, changed)`` where ``anomalies`` lists the checks the
+        reading failed and ``changed`` is True when the device just entered or
+        left quarantine (see ``is_quarantined``). The first reading of a device
+        also reports a change, so the published state is refreshed after a
+        restart and a device that recovered meanwhile is released.
+        """
+        row = self._index.get(esp32_id)
+        first = row is None
+        if first:
+            row = self._add_device(esp32_id)
+
+        anomalies = []
+        if raw_moisture is not None:
+            if raw_moisture <= self.raw_min or raw_moisture >= self.raw_max:
+                anomalies.append("raw_moisture_pinned")
+            self._check(RAW_MOISTURE, row, float(raw_moisture), bool(anomalies), anomalies)
+        if temperature is not None:
+            out_of_range = not (self.temperature_min <= temperature <= self.temperature_max)
+            if out_of_range:
+                anomalies.append("temperature_out_of_range")
+            self._check(TEMPERATURE, row, float(temperature), out_of_range, anomalies)
+
+        quarantined = self._quarantined[row]
+        if bool(anomalies) == bool(quarantined):
+            self._streak[row] = 0
+            return anomalies, first
+        streak = self._streak[row] + 1
+        if streak < (self.release_after if quarantined else self.quarantine_after):
+            self._streak[row] = streak
+            return anomalies, first
+        self._streak[row] = 0
+        self._quarantined[row] = 1 - quarantined
+        return anomalies, True
+
+    def _add_device(self, esp32_id):
+        row = len(self._quarantined)
+        self._index[esp32_id] = row
+        self._quarantined.append(0)
+        self._streak.append(0)
+        for metric in range(len(METRICS)):
+            self._count[metric].append(0)
+            self._mean[metric].append(0.0)
+            self._m2[metric].append(0.0)
+            self._ewma[metric].append(0.0)
+            self._last[metric].append(math.nan)
+            self._run[metric].append(0)
+        return row
+
+    def _check(self, metric, row, value, suspect, anomalies):
+        name = METRICS[metric]
+
+        # Stuck value run length. Compare at float32 precision, as stored.
+        last = self._last[metric]
+        run = self._run[metric]
+        if array("f", (value,))[0] == last[row]:
+            if run[row] < 0xFFFF:
+                run[row] += 1
+        else:
+            run[row] = 1
+            last[row] = value
+        stuck_run = self.stuck_runs[metric]
+        if stuck_run and run[row] >= stuck_run:
+            anomalies.append(f"{name}_stuck")
+            suspect = True
+
+        count = self._count[metric]
+        mean = self._mean[metric]
+        m2 = self._m2[metric]
+        ewma = self._ewma[metric]
+        n = count[row]
+
+        if suspect:
+            return
+
+        if n >= self.warmup:
+            std = math.sqrt(m2[row] / (n - 1))
+            if std > 0 and abs(value - ewma[row]) > self.z_threshold * std:
+                anomalies.append(f"{name}_spike")
+                # Let the level follow a lasting shift, but keep the spread clean
+                ewma[row] += self.alpha * (value - ewma[row])
+                return
+
+        # Welford update of mean and variance, then the EWMA level
+        n += 1
+        count[row] = n
+        delta = value - mean[row]
+        mean[row] += delta / n
+        m2[row] += delta * (value - mean[row])
+        ewma[row] = value if n == 1 else ewma[row] + self.alpha * (value - ewma[row])
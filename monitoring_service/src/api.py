@@ -1,10 +1,27 @@
-from flask_restx import Api, Namespace, Resource, fields
+from flask_restx import Api, Namespace, Resource, fields, reqparse
 from flask_jwt_extended import jwt_required
-from flask import jsonify, request
+from flask import Response, jsonify, request, stream_with_context
+import csv
+import io
+import json
 import os
-from influxdb_client import InfluxDBClient, Point
+import re
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+from influxdb_client import Dialect, InfluxDBClient, Point
 from dotenv import load_dotenv
 import random
+from presence import PresenceTracker
+from rate_limit import RateLimiter
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional
+    pa = pq = None
+
+
+logger = getLogger(__name__)
 
 
 # load environmental variables
@@ -14,6 +31,8 @@ INFLUXDB_URL = os.getenv("INFLUXDB_URL")
 INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
 INFLUXDB_ORG = os.getenv("INFLUXDB_ORG")
 INFLUXDB_BUCKET = os.getenv("INFLUXDB_BUCKET")
+PRESENCE_TIMEOUT = float(os.getenv("PRESENCE_TIMEOUT", "300"))
+PRESENCE_GRANULARITY = float(os.getenv("PRESENCE_GRANULARITY", "10"))
 
 
 authorizations = {
@@ -44,16 +63,46 @@ influx_client = InfluxDBClient(
 query_api = influx_client.query_api()
 write_api = influx_client.write_api()
 
+# Per-client token buckets shared by all workers, plus per-class concurrency caps
+limiter = RateLimiter("monitoring_service")
+
+# Last-seen tracking for every device, fed by the MQTT ingest path
+presence = PresenceTracker(timeout=PRESENCE_TIMEOUT, granularity=PRESENCE_GRANULARITY)
+
 simulate_model = sensor_ns.model("Simulate", {
     "farm_id": fields.Integer(required=True),
 
 })
 
+export_parser = reqparse.RequestParser()
+export_parser.add_argument("start", location="args", required=True,
+                           help="RFC3339 start of the export range, e.g. 2025-01-01T00:00:00Z")
+export_parser.add_argument("stop", location="args", help="RFC3339 end of the export range, defaults to now")
+export_parser.add_argument("esp32_id", location="args", action="append",
+                           help="Devices to export, repeat or comma separate. Defaults to all devices")
+export_parser.add_argument("format", location="args", choices=("csv", "parquet"), default="csv")
+export_parser.add_argument("window_hours", location="args", type=float, default=24,
+                           help="Size of the time window fetched from InfluxDB per query")
+export_parser.add_argument("cursor", location="args",
+                           help="Resume after this _time, i.e. the _time of the last row received")
+export_parser.add_argument("cursor_esp32_id", location="args",
+                           help="esp32_id of the last row received, so devices sharing its _time are not skipped")
+
+fleet_parser = reqparse.RequestParser()
+fleet_parser.add_argument("esp32_id", location="args", help="Return the presence of a single device")
+fleet_parser.add_argument("offline_limit", location="args", type=int, default=0,
+                          help="Also list up to this many offline devices")
+
+EXPORT_COLUMNS = ["_time", "esp32_id", "quality", "moisture", "temperature", "raw_moisture"]
+EXPORT_FLUSH_BYTES = 64 * 1024
+EXPORT_ROW_GROUP_SIZE = 50_000
+
 
 @sensor_ns.route("/<string:esp32_id>")
 class SensorData(Resource):
     @sensor_ns.doc(security='Bearer')
     @jwt_required()
+    @limiter.limit("query", rate=5, burst=10, concurrency=8)
     def get(self, esp32_id):
         query = f'''
         from(bucket: "{INFLUXDB_BUCKET}")
@@ -79,9 +128,31 @@ class SensorData(Resource):
 
 
 
+@sensor_ns.route("/fleet/status")
+class FleetStatus(Resource):
+    @sensor_ns.doc(security='Bearer')
+    @sensor_ns.expect(fleet_parser)
+    @jwt_required()
+    @limiter.limit("fleet", rate=10, burst=20)
+    def get(self):
+        """Online/offline counts for the fleet, or the presence of one device."""
+        args = fleet_parser.parse_args()
+        if args["esp32_id"]:
+            status = presence.status(args["esp32_id"])
+            if status is None:
+                return {"error": "Device has not reported since the service started"}, 404
+            return status, 200
+
+        data = presence.summary()
+        if args["offline_limit"] > 0:
+            data["offline_devices"] = presence.offline_devices(args["offline_limit"])
+        return data, 200
+
+
 @sensor_ns.route("/simulate")
 class SimulateSensor(Resource):
     @sensor_ns.expect(simulate_model)
+    @limiter.limit("simulate", rate=1, burst=5)
     def post(self, farm_id="demo-farm"):
         # Generate random values
         moisture = random.uniform(300, 800)
@@ -119,4 +190,214 @@ class SimulateSensor(Resource):
             return jsonify({"error": str(e)}), 500
 
 
+def _parse_time(value):
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def _flux_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+_RFC3339 = re.compile(r"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d{1,9}))?(Z|[+-]\d\d:\d\d)$")
+
+
+def _parse_time_ns(value):
+    """RFC3339 with up to nanosecond precision -> nanoseconds since the epoch.
+
+    InfluxDB timestamps are in nanoseconds, more than a datetime can hold.
+    """
+    match = _RFC3339.match(value)
+    if not match:
+        raise ValueError(f"Invalid RFC3339 timestamp: {value}")
+    seconds = _parse_time(match.group(1) + match.group(3))
+    return int(seconds.timestamp()) * 10**9 + int((match.group(2) or "").ljust(9, "0"))
+
+
+def _flux_time_ns(value):
+    seconds, nanos = divmod(value, 10**9)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S") + f".{nanos:09d}Z"
+
+
+def _export_query(window_start, window_stop, esp32_ids, after=None):
+    """Flux query for one export window, one row per reading.
+
+    ``after`` is the ``(_time in ns, esp32_id or None)`` of the last row sent,
+    matching the export's sort order.
+    """
+    device_filter = ""
+    if esp32_ids:
+        device_filter = f"|> filter(fn: (r) => contains(value: r.esp32_id, set: {json.dumps(esp32_ids)}))"
+    cursor_filter = ""
+    if after is not None:
+        after_time, after_esp32_id = after
+        condition = f"r._time > {_flux_time_ns(after_time)}"
+        if after_esp32_id is not None:
+            condition += f" or (r._time == {_flux_time_ns(after_time)} and r.esp32_id > {json.dumps(after_esp32_id)})"
+        cursor_filter = f"|> filter(fn: (r) => {condition})"
+    return f'''
+    from(bucket: "{INFLUXDB_BUCKET}")
+      |> range(start: {_flux_time(window_start)}, stop: {_flux_time(window_stop)})
+      |> filter(fn: (r) => r._measurement == "sensor_readings")
+      {device_filter}
+      |> filter(fn: (r) => r._field == "moisture" or r._field == "temperature" or r._field == "raw_moisture")
+      |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+      |> group()
+      |> sort(columns: ["_time", "esp32_id"])
+      {cursor_filter}
+      |> keep(columns: {json.dumps(EXPORT_COLUMNS)})
+    '''
+
+
+def _export_rows(start, stop, esp32_ids, window, cursor=None):
+    """
+    Yields export rows window by window.
+
+    Each window is streamed from InfluxDB as raw CSV, line by line, so only
+    the record being written is held in memory whatever the size of the
+    range. ``_time`` is passed on as InfluxDB's RFC3339 string, which keeps
+    its nanoseconds, and ``cursor`` is ``(_time in ns, esp32_id or None)``.
+    """
+    window_start = start
+    if cursor is not None:
+        # Whole microseconds at or before the cursor; the cursor filter does the rest
+        seconds, nanos = divmod(cursor[0], 10**9)
+        cursor_start = datetime.fromtimestamp(seconds, tz=timezone.utc) + timedelta(microseconds=nanos // 1000)
+        window_start = max(start, cursor_start)
+    after = cursor
+    dialect = Dialect(header=True, annotations=[])
+    while window_start < stop:
+        window_stop = min(window_start + window, stop)
+        query = _export_query(window_start, window_stop, esp32_ids, after)
+        header = None
+        for line in query_api.query_csv(query, dialect=dialect):
+            if not line or not any(line):
+                continue
+            if header is None or line == header:
+                header = line
+                index = [header.index(column) if column in header else None for column in EXPORT_COLUMNS]
+                continue
+            values = [line[i] if i is not None and line[i] != "" else None for i in index]
+            yield tuple(values[:3]) + tuple(None if value is None else float(value) for value in values[3:])
+        window_start, after = window_stop, None
+
+
+def _export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_FLUSH_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands the Parquet writer's output back in chunks."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _export_parquet(rows):
+    schema = pa.schema([
+        ("_time", pa.timestamp("ns", tz="UTC")),
+        ("esp32_id", pa.string()),
+        ("quality", pa.string()),
+        ("moisture", pa.float64()),
+        ("temperature", pa.float64()),
+        ("raw_moisture", pa.float64()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    columns = [[] for _ in EXPORT_COLUMNS]
+
+    def write_row_group():
+        columns[0] = [_parse_time_ns(value) for value in columns[0]]
+        writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+        for column in columns:
+            column.clear()
+        return sink.drain()
+
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(value)
+        if len(columns[0]) >= EXPORT_ROW_GROUP_SIZE:
+            yield write_row_group()
+    if columns[0]:
+        yield write_row_group()
+    writer.close()
+    yield sink.drain()
+
+
+@sensor_ns.route("/export")
+class SensorExport(Resource):
+    @sensor_ns.doc(security='Bearer')
+    @sensor_ns.expect(export_parser)
+    @jwt_required()
+    @limiter.limit("export", rate=0.1, burst=2, concurrency=2)
+    def get(self):
+        """Streams raw sensor history as CSV or Parquet without loading it into memory."""
+        args = export_parser.parse_args()
+        try:
+            start = _parse_time(args["start"])
+            stop = _parse_time(args["stop"]) if args["stop"] else datetime.now(timezone.utc)
+            cursor = (_parse_time_ns(args["cursor"]), args["cursor_esp32_id"]) if args["cursor"] else None
+        except ValueError:
+            return {"error": "start, stop and cursor must be RFC3339 timestamps"}, 400
+        if args["window_hours"] <= 0:
+            return {"error": "window_hours must be positive"}, 400
+        if args["format"] == "parquet" and pq is None:
+            return {"error": "Parquet export is not available on this server"}, 501
+
+        esp32_ids = [
+            esp32_id for value in (args["esp32_id"] or []) for esp32_id in value.split(",") if esp32_id
+        ]
+        rows = _export_rows(start, stop, esp32_ids, timedelta(hours=args["window_hours"]), cursor)
+
+        def generate(chunks):
+            try:
+                yield from chunks
+            except Exception as e:
+                # Headers are already sent. Re-raising makes the server drop the connection
+                # without the final chunk, so the client knows the body is incomplete and can
+                # resume from its cursor instead of taking a truncated file as complete.
+                logger.error(f"Sensor export failed: {e}")
+                raise
+
+        if args["format"] == "parquet":
+            return Response(
+                stream_with_context(generate(_export_parquet(rows))),
+                mimetype="application/vnd.apache.parquet",
+                headers={"Content-Disposition": "attachment; filename=sensor_readings.parquet"},
+            )
+        return Response(
+            stream_with_context(generate(_export_csv(rows))),
+            mimetype="text/csv",
+            headers={"Content-Disposition": "attachment; filename=sensor_readings.csv"},
+        )
+
+
 api.add_namespace(sensor_ns, path="/sensors")
\ No newline at end of file
@@ -1,34 +1,39 @@
 import os
 import json
-import logging
-from datetime import datetime
+from datetime import datetime, timezone
 
 import requests
 import paho.mqtt.client as mqtt
 from flask import Flask, Blueprint
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
 from influxdb_client import InfluxDBClient, Point
 from influxdb_client.client.write_api import SYNCHRONOUS
-from api import api
+from api import api, presence
+from anomaly import AnomalyDetector
+from logging_config import setup_logging
 
 # Load .env
 load_dotenv()
 
+# Background log writer; level, format and per-device sampling come from LOG_* env vars
+setup_logging("monitoring_service")
+
 INFLUXDB_URL = os.getenv("INFLUXDB_URL")
 INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
 INFLUXDB_ORG = os.getenv("INFLUXDB_ORG")
 INFLUXDB_BUCKET = os.getenv("INFLUXDB_BUCKET")
 
 app = Flask(__name__)
+# Behind the load balancer; take the client address from X-Forwarded-For so rate limits are per client
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv("TRUSTED_PROXY_HOPS", "1")))
 CORS(app)
 
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")
 app.config['JWT_VERIFY_SUB'] = False
 
-app.logger.setLevel(logging.DEBUG)
-
 jwt = JWTManager(app)
 
 # InfluxDB setup
@@ -43,6 +48,21 @@ MQTT_PORT = int(os.getenv("MQTT_PORT"))
 MONITORING_TOPIC = os.getenv("MONITORING_TOPIC")
 MQTT_USERNAME = os.getenv("MQTT_USERNAME")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+ANOMALY_TOPIC = os.getenv("ANOMALY_TOPIC", "sensors/anomalies/{esp32_id}")
+PRESENCE_TOPIC = os.getenv("PRESENCE_TOPIC", "system/{esp32_id}/status")
+
+# Streaming anomaly detection for incoming readings
+detector = AnomalyDetector(
+    raw_min=float(os.getenv("ANOMALY_RAW_MIN", "0")),
+    raw_max=float(os.getenv("ANOMALY_RAW_MAX", "4095")),
+    temperature_min=float(os.getenv("ANOMALY_TEMPERATURE_MIN", "-20")),
+    temperature_max=float(os.getenv("ANOMALY_TEMPERATURE_MAX", "60")),
+    z_threshold=float(os.getenv("ANOMALY_Z_THRESHOLD", "4")),
+    stuck_run=int(os.getenv("ANOMALY_STUCK_RUN", "30")),
+    temperature_stuck_run=int(os.getenv("ANOMALY_TEMPERATURE_STUCK_RUN", "0")),
+    quarantine_after=int(os.getenv("ANOMALY_QUARANTINE_AFTER", "3")),
+    release_after=int(os.getenv("ANOMALY_RELEASE_AFTER", "3")),
+)
 
 def on_connect(mqtt_client, userdata, flags, rc):
     if rc == 0:
@@ -83,19 +103,49 @@ def on_message(mqtt_client, userdata, msg):
             app.logger.warning("Invalid sensor data received")
             return
 
+        presence.seen(esp32_id)
+
+        anomalies, changed = detector.observe(esp32_id, raw_moisture, temperature)
+        if changed:
+            quarantined = detector.is_quarantined(esp32_id)
+            # Retained per device, so the irrigation service picks up every device's state after a restart
+            mqtt_client.publish(ANOMALY_TOPIC.format(esp32_id=esp32_id), json.dumps({
+                "esp32_id": esp32_id,
+                "quarantined": quarantined,
+                "anomalies": anomalies,
+            }), qos=1, retain=True)
+            if quarantined:
+                app.logger.warning(f"Quarantining ESP32 {esp32_id}: {', '.join(anomalies)}")
+            else:
+                app.logger.info(f"ESP32 {esp32_id} is not quarantined")
+
         point = (
             Point("sensor_readings")
             .tag("esp32_id", esp32_id)
+            .tag("quality", "suspect" if anomalies else "ok")
             .field("moisture", moisture)
             .field("temperature", temperature)
             .field("raw_moisture", raw_moisture)
         )
+        if anomalies:
+            point = point.field("anomalies", ",".join(anomalies))
         write_api.write(bucket=INFLUXDB_BUCKET, record=point)
-        app.logger.info(f"Data written for ESP32 {esp32_id} at")
+        app.logger.info("Data written for ESP32 %s", esp32_id, extra={"esp32_id": esp32_id})
 
     except Exception as e:
         app.logger.error(f"Error processing MQTT message: {e}")
 
+def publish_presence(esp32_id, online, last_seen):
+    """Publishes online/offline transitions, retained per device."""
+    client.publish(PRESENCE_TOPIC.format(esp32_id=esp32_id), json.dumps({
+        "esp32_id": esp32_id,
+        "status": "online" if online else "offline",
+        "last_seen": datetime.fromtimestamp(last_seen, tz=timezone.utc).isoformat(),
+    }), qos=1, retain=True)
+    if not online:
+        app.logger.warning(f"ESP32 {esp32_id} went offline")
+
+
 # MQTT setup
 client = mqtt.Client()
 client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
@@ -105,6 +155,9 @@ client.on_message = on_message
 client.connect(MQTT_BROKER, MQTT_PORT)
 client.loop_start()
 
+presence.on_change = publish_presence
+presence.start()
+
 # API
 
 # Create blueprint for user service
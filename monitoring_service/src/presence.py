@@ -0,0 +1,110 @@
+import itertools
+import threading
+import time
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class PresenceTracker:
+    """
+    Tracks which ESP32s are still reporting.
+
+    Every device sits in the bucket of its offline deadline (last seen plus
+    ``timeout``), rounded up to ``granularity`` seconds. A reading moves the
+    device to a later bucket and expiry only walks the buckets whose deadline
+    has passed, so both are O(1) per device with no scan of the fleet. Online
+    and offline counts are kept up to date as devices change state.
+
+    ``on_change(esp32_id, online, last_seen)`` is called for every transition,
+    outside the tracker's lock.
+    """
+
+    def __init__(self, timeout=300, granularity=10, on_change=None):
+        self.timeout = timeout
+        self.granularity = granularity
+        self.on_change = on_change
+        self._last_seen = {}  # esp32_id -> timestamp
+        self._bucket_of = {}  # esp32_id -> bucket, online devices only
+        self._buckets = {}    # bucket -> set of esp32_ids
+        self._offline = set()
+        self._next_bucket = int(time.time() // granularity)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="presence", daemon=True)
+            self._thread.start()
+
+    def seen(self, esp32_id, now=None):
+        """Records a reading from a device."""
+        now = time.time() if now is None else now
+        bucket = -int(-(now + self.timeout) // self.granularity)
+        with self._lock:
+            # Never behind the expiry cursor, or the device would never expire
+            bucket = max(bucket, self._next_bucket)
+            self._last_seen[esp32_id] = now
+            came_online = esp32_id in self._offline or esp32_id not in self._bucket_of
+            self._offline.discard(esp32_id)
+
+            previous = self._bucket_of.get(esp32_id)
+            if previous != bucket:
+                if previous is not None:
+                    self._buckets[previous].discard(esp32_id)
+                self._buckets.setdefault(bucket, set()).add(esp32_id)
+                self._bucket_of[esp32_id] = bucket
+
+        if came_online:
+            self._notify(esp32_id, True, now)
+
+    def expire(self, now=None):
+        """Marks devices whose deadline has passed as offline. Returns them."""
+        now = time.time() if now is None else now
+        current = int(now // self.granularity)
+        expired = []
+        with self._lock:
+            while self._next_bucket <= current:
+                for esp32_id in self._buckets.pop(self._next_bucket, ()):
+                    del self._bucket_of[esp32_id]
+                    self._offline.add(esp32_id)
+                    expired.append((esp32_id, self._last_seen[esp32_id]))
+                self._next_bucket += 1
+
+        for esp32_id, last_seen in expired:
+            self._notify(esp32_id, False, last_seen)
+        return [esp32_id for esp32_id, _ in expired]
+
+    def status(self, esp32_id):
+        with self._lock:
+            last_seen = self._last_seen.get(esp32_id)
+            if last_seen is None:
+                return None
+            return {"esp32_id": esp32_id, "online": esp32_id in self._bucket_of, "last_seen": last_seen}
+
+    def summary(self):
+        with self._lock:
+            online = len(self._bucket_of)
+            offline = len(self._offline)
+        return {"online": online, "offline": offline, "total": online + offline}
+
+    def offline_devices(self, limit=100):
+        with self._lock:
+            return [
+                {"esp32_id": esp32_id, "last_seen": self._last_seen[esp32_id]}
+                for esp32_id in itertools.islice(self._offline, limit)
+            ]
+
+    def _notify(self, esp32_id, online, last_seen):
+        if self.on_change is None:
+            return
+        try:
+            self.on_change(esp32_id, online, last_seen)
+        except Exception as e:
+            logger.error(f"Error publishing presence for {esp32_id}: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.granularity)
+            self.expire()
@@ -1,9 +1,13 @@
+import json
 import os
 from dotenv import load_dotenv
 from flask_restx import Api, Resource, Namespace, fields, reqparse
 from flask_jwt_extended import jwt_required, create_access_token, get_jwt_identity
-from flask import request
+from flask import Response, request, stream_with_context
 from models import User, Farm, db
+from bulk_import import FarmBulkImport
+from rate_limit import RateLimiter, client_identity
+from threshold_cache import threshold_cache
 from logging import getLogger
 
 
@@ -39,6 +43,37 @@ threshold_parser.add_argument(
     required=True,
     help="Your API key"
 )
+threshold_parser.add_argument(
+    'If-None-Match',
+    location='headers',
+    required=False,
+    help="ETag from a previous response; unchanged thresholds return 304"
+)
+threshold_parser.add_argument(
+    'format',
+    location='args',
+    required=False,
+    choices=("json", "compact"),
+    help="compact returns moisture_lower,moisture_upper,temperature_lower,temperature_upper as plain text"
+)
+
+# Per-client token buckets shared by all workers, plus per-class concurrency caps
+limiter = RateLimiter("user_service")
+
+
+def account_identity(**kwargs):
+    """Logins are also limited per account, so one account cannot be guessed at from many addresses."""
+    data = request.get_json(silent=True)
+    email = data.get("email") if isinstance(data, dict) else None
+    if isinstance(email, str) and email.strip():
+        return f"email:{email.strip().lower()}"
+    return client_identity()
+
+
+def device_identity(esp32_id, **kwargs):
+    """Devices share one API key, so threshold polls are limited per device and per calling service."""
+    caller = request.headers.get("X-Service-Name", "device")
+    return f"{caller}:{esp32_id}:{client_identity()}"
 
 user_ns = Namespace("users", description="User operations")
 farm_ns = Namespace("farms", description="Farm operations")
@@ -75,6 +110,13 @@ threshold_model = farm_ns.model("Threshold", {
     "temperature_lower_threshold": fields.Float(required=False),
 })
 
+bulk_farms_model = farm_ns.model("BulkFarms", {
+    "farms": fields.List(fields.Nested(create_farm_model), required=True),
+})
+
+# Rows validated and written per set-based query
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+
 update_farm_model = farm_ns.model("UpdateFarm", {
     "esp32_id": fields.String(required=False),
     "farm_name": fields.String(required=False),
@@ -88,6 +130,7 @@ update_farm_model = farm_ns.model("UpdateFarm", {
 @user_ns.route("/signup")
 class UserSignup(Resource):
     @user_ns.expect(signup_model)
+    @limiter.limit("signup", rate=0.2, burst=3, concurrency=2)
     def post(self):
         data = request.json
         if User.query.filter_by(email=data["email"]).first():
@@ -102,6 +145,8 @@ class UserSignup(Resource):
 @user_ns.route("/login")
 class UserLogin(Resource):
     @user_ns.expect(login_model)
+    @limiter.limit("login", rate=1, burst=10, concurrency=4)
+    @limiter.limit("login_account", rate=0.2, burst=5, key=account_identity)
     def post(self):
         data = request.json
         user = User.query.filter_by(email=data["email"]).first()
@@ -120,6 +165,7 @@ class FarmCreate(Resource):
     @farm_ns.expect(create_farm_model)
     @farm_ns.doc(security='Bearer')
     @jwt_required()
+    @limiter.limit("farms", rate=10, burst=20)
     def post(self):
         user_id = get_jwt_identity()
         data = request.json
@@ -148,11 +194,74 @@ class FarmCreate(Resource):
             return {"error": "Error creating farm"}, 500
 
 
+@farm_ns.route("/bulk")
+class FarmBulkUpsert(Resource):
+    @farm_ns.expect(bulk_farms_model)
+    @farm_ns.doc(security='Bearer', description=(
+        "Creates or updates farms by esp32_id in one transaction. Send JSON with a `farms` list, "
+        "or `application/x-ndjson` with one farm per line to get progress streamed back per batch."
+    ))
+    @jwt_required()
+    @limiter.limit("bulk", rate=0.1, burst=2, concurrency=2)
+    def post(self):
+        user_id = get_jwt_identity()
+        if request.mimetype == "application/x-ndjson":
+            return Response(
+                stream_with_context(self._stream(FarmBulkImport(user_id))),
+                mimetype="application/x-ndjson",
+            )
+
+        data = request.get_json(silent=True)
+        farms = data.get("farms") if isinstance(data, dict) else data
+        if not isinstance(farms, list):
+            return {"error": "Expected a list of farms"}, 400
+
+        bulk = FarmBulkImport(user_id)
+        try:
+            for start in range(0, len(farms), BULK_BATCH_SIZE):
+                bulk.add_batch(farms[start:start + BULK_BATCH_SIZE])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error importing farms: {e}")
+            return {"error": "Error importing farms"}, 500
+        return dict(bulk.summary(), errors=bulk.errors), 200
+
+    @staticmethod
+    def _stream(bulk):
+        """Reads NDJSON rows from the request body and yields a progress line per batch."""
+        def flush(batch):
+            errors = bulk.add_batch(batch)
+            return json.dumps(dict(bulk.summary(), errors=errors)) + "\n"
+
+        try:
+            batch = []
+            for line in request.stream:
+                if not line.strip():
+                    continue
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    batch.append(None)  # reported as an invalid row
+                if len(batch) >= BULK_BATCH_SIZE:
+                    yield flush(batch)
+                    batch = []
+            if batch:
+                yield flush(batch)
+            db.session.commit()
+            yield json.dumps(dict(bulk.summary(), done=True)) + "\n"
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error importing farms: {e}")
+            yield json.dumps({"error": "Error importing farms, nothing was saved", "done": True}) + "\n"
+
+
 @farm_ns.route("/update_threshold/<int:farm_id>")
 class UpdateFarmThreshold(Resource):
     @farm_ns.expect(threshold_model)
     @farm_ns.doc(security='Bearer')
     @jwt_required()
+    @limiter.limit("farms", rate=10, burst=20)
     def put(self, farm_id):
         user_id = get_jwt_identity()
         farm = Farm.query.filter_by(id=farm_id, user_id=user_id).first()
@@ -170,34 +279,64 @@ class UpdateFarmThreshold(Resource):
         return {"message": "Thresholds updated successfully"}, 200
 
 
+THRESHOLD_FIELDS = (
+    "moisture_lower_threshold",
+    "moisture_upper_threshold",
+    "temperature_lower_threshold",
+    "temperature_upper_threshold",
+)
+
+
+def format_compact_thresholds(thresholds):
+    """Thresholds as one comma separated line, empty for unset values.
+
+    ``repr`` is the shortest string that reads back as the same float, so the
+    device gets exactly the stored values.
+    """
+    return ",".join(
+        "" if thresholds[field] is None else repr(float(thresholds[field])) for field in THRESHOLD_FIELDS
+    )
+
+
 @farm_ns.route("/threshold/<string:esp32_id>")
 class GetFarmThreshold(Resource):
     @farm_ns.expect(threshold_parser)
+    @limiter.limit("device", rate=100, burst=200, key=device_identity)
     def get(self, esp32_id):
         api_key = request.headers.get("X-API-KEY")
         expected_key = os.getenv("API_KEY")
 
-        logger.info(f"API_KEY: {api_key}")
-
         if api_key != expected_key:
             return {"error": "Unauthorized"}, 401
 
-        farm = Farm.query.filter_by(esp32_id=esp32_id).first()
-        if not farm:
-            return {"error": "Farm not found or unauthorized"}, 404
-
-        return {
-            "moisture_lower_threshold": farm.moisture_lower_threshold,
-            "moisture_upper_threshold": farm.moisture_upper_threshold,
-            "temperature_lower_threshold": farm.temperature_lower_threshold,
-            "temperature_upper_threshold": farm.temperature_upper_threshold
-        }, 200
+        cached = threshold_cache.get(esp32_id)
+        if cached is None:
+            generation = threshold_cache.generation
+            farm = Farm.query.filter_by(esp32_id=esp32_id).first()
+            if not farm:
+                return {"error": "Farm not found or unauthorized"}, 404
+            cached = (farm.etag, {field: getattr(farm, field) for field in THRESHOLD_FIELDS})
+            threshold_cache.put(esp32_id, *cached, generation)
+
+        etag, thresholds = cached
+        compact = request.args.get("format") == "compact"
+        if compact:
+            # .c2: devices holding a body from the older, rounded format must refetch
+            etag = f"{etag}.c2"
+        headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        if compact:
+            return Response(format_compact_thresholds(thresholds), mimetype="text/plain", headers=headers)
+        return thresholds, 200, headers
 
 
 @farm_ns.route("/my_farms")
 class FarmsByUser(Resource):
     @farm_ns.doc(security='Bearer')
     @jwt_required()
+    @limiter.limit("farms", rate=10, burst=20)
     def get(self):
         user_id = get_jwt_identity()
         farms = Farm.query.filter_by(user_id=user_id).all()
@@ -222,6 +361,7 @@ class FarmUpdate(Resource):
     @farm_ns.expect(update_farm_model)
     @farm_ns.doc(security="Bearer")
     @jwt_required()
+    @limiter.limit("farms", rate=10, burst=20)
     def put(self, farm_id):
         user_id = get_jwt_identity()
         farm = Farm.query.filter_by(id=farm_id, user_id=user_id).first()
@@ -245,6 +385,7 @@ class FarmUpdate(Resource):
 class FarmDelete(Resource):
     @farm_ns.doc(security="Bearer")
     @jwt_required()
+    @limiter.limit("farms", rate=10, burst=20)
     def delete(self, farm_id):
         user_id = get_jwt_identity()
         farm = Farm.query.filter_by(id=farm_id, user_id=user_id).first()
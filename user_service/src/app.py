@@ -4,15 +4,23 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
 from models import db
 from api import api
+from threshold_cache import threshold_cache
 from logging import getLogger
+from logging_config import setup_logging
 
 # Load environment variables
 load_dotenv()
 
+# Background log writer; level and format come from LOG_* env vars
+setup_logging("user_service")
+
 app = Flask(__name__)
+# Behind the load balancer; take the client address from X-Forwarded-For so rate limits are per client
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv("TRUSTED_PROXY_HOPS", "1")))
 CORS(app)
 
 # Database config
@@ -36,6 +44,9 @@ db.init_app(app)
 migrate = Migrate(app, db)
 jwt = JWTManager(app)
 
+# Drop cached thresholds whenever a farm change is committed
+threshold_cache.register()
+
 # Initialize API
 # Create blueprint for user service
 user_bp = Blueprint("user_bp", __name__, url_prefix="/user")
@@ -55,4 +66,4 @@ with app.app_context():
     db.create_all()
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=False, port=5000) #TODO: turn off debug and configure logging
\ No newline at end of file
+    app.run(host="0.0.0.0", debug=False, port=5000)
\ No newline at end of file
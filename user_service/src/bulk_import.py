@@ -0,0 +1,160 @@
+import math
+
+from sqlalchemy import insert, or_, select, update
+
+from models import Farm, db
+from threshold_cache import threshold_cache
+
+
+# Request field -> Farm column
+FARM_FIELDS = {
+    "farm_name": "name",
+    "location": "location",
+    "soil_type": "soil_type",
+    "crop_type": "crop_type",
+    "size": "size_unit",
+    "moisture_upper_threshold": "moisture_upper_threshold",
+    "moisture_lower_threshold": "moisture_lower_threshold",
+    "temperature_upper_threshold": "temperature_upper_threshold",
+    "temperature_lower_threshold": "temperature_lower_threshold",
+}
+
+THRESHOLD_FIELDS = {
+    "moisture_upper_threshold",
+    "moisture_lower_threshold",
+    "temperature_upper_threshold",
+    "temperature_lower_threshold",
+}
+
+# Column -> max length, so bad rows are reported instead of failing the whole executemany
+STRING_LENGTHS = {
+    column.name: column.type.length
+    for column in Farm.__table__.columns
+    if getattr(column.type, "length", None)
+}
+
+
+class FarmBulkImport:
+    """
+    Creates or updates many farms for one user inside the current transaction.
+
+    Rows are keyed by ``esp32_id``: a new ESP32 creates a farm, one the user
+    already owns updates it. Each batch checks ``esp32_id`` and name
+    uniqueness against the database with a single query and writes with one
+    executemany INSERT and one executemany UPDATE. Rows that fail validation
+    are reported and skipped; the caller decides when to commit.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = int(user_id)
+        self.processed = 0
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+        self._seen_esp32_ids = set()
+        self._seen_names = set()
+
+    def summary(self):
+        return {
+            "processed": self.processed,
+            "created": self.created,
+            "updated": self.updated,
+            "failed": len(self.errors),
+        }
+
+    def add_batch(self, rows):
+        """Validates and writes one batch. Returns the errors of this batch."""
+        errors = []
+        candidates = []
+        for offset, data in enumerate(rows):
+            index = self.processed + offset
+            values, error = self._parse(data)
+            if error:
+                errors.append({"row": index, "esp32_id": values.get("esp32_id"), "error": error})
+            else:
+                candidates.append((index, values))
+        self.processed += len(rows)
+
+        esp32_ids = [values["esp32_id"] for _, values in candidates]
+        names = [values["name"] for _, values in candidates if "name" in values]
+        existing = db.session.execute(
+            select(Farm.id, Farm.esp32_id, Farm.name, Farm.user_id, Farm.version)
+            .where(or_(Farm.esp32_id.in_(esp32_ids), Farm.name.in_(names)))
+        ).all() if candidates else []
+        by_esp32_id = {farm.esp32_id: farm for farm in existing}
+        by_name = {farm.name: farm for farm in existing}
+
+        inserts, updates = [], []
+        for index, values in candidates:
+            esp32_id = values["esp32_id"]
+            current = by_esp32_id.get(esp32_id)
+            name_owner = by_name.get(values.get("name"))
+
+            error = None
+            if esp32_id in self._seen_esp32_ids:
+                error = "Duplicate esp32_id in upload"
+            elif "name" in values and values["name"] in self._seen_names:
+                error = "Duplicate farm_name in upload"
+            elif current is not None and current.user_id != self.user_id:
+                error = "ESP32 is registered to another farm"
+            elif name_owner is not None and name_owner.esp32_id != esp32_id:
+                error = "Farm name already taken"
+            elif current is None and "name" not in values:
+                error = "farm_name is required for a new farm"
+            if error:
+                errors.append({"row": index, "esp32_id": esp32_id, "error": error})
+                continue
+
+            self._seen_esp32_ids.add(esp32_id)
+            if "name" in values:
+                self._seen_names.add(values["name"])
+            if current is None:
+                inserts.append(dict(values, user_id=self.user_id))
+            else:
+                updates.append(dict(values, id=current.id, version=current.version + 1))
+
+        if inserts:
+            db.session.execute(insert(Farm), inserts)
+        if updates:
+            db.session.execute(update(Farm), updates)
+        threshold_cache.mark_changed(db.session, [values["esp32_id"] for values in updates])
+
+        errors.sort(key=lambda error: error["row"])
+        self.created += len(inserts)
+        self.updated += len(updates)
+        self.errors.extend(errors)
+        return errors
+
+    @staticmethod
+    def _parse(data):
+        if not isinstance(data, dict):
+            return {}, "Row must be an object"
+        esp32_id = data.get("esp32_id")
+        if not isinstance(esp32_id, str) or not esp32_id:
+            return {}, "esp32_id is required"
+        if len(esp32_id) > STRING_LENGTHS["esp32_id"]:
+            return {}, f"esp32_id must be at most {STRING_LENGTHS['esp32_id']} characters"
+
+        values = {"esp32_id": esp32_id}
+        for field, column in FARM_FIELDS.items():
+            if field not in data:
+                continue
+            value = data[field]
+            if field in THRESHOLD_FIELDS:
+                value = None if value in ("", None) else value
+                if value is not None:
+                    try:
+                        value = float(value)
+                    except (TypeError, ValueError):
+                        return values, f"{field} must be a number"
+                    if not math.isfinite(value):
+                        return values, f"{field} must be a finite number"
+            elif value is not None:
+                if not isinstance(value, str):
+                    return values, f"{field} must be a string"
+                if column in STRING_LENGTHS and len(value) > STRING_LENGTHS[column]:
+                    return values, f"{field} must be at most {STRING_LENGTHS[column]} characters"
+            values[column] = value
+        if "name" in values and not values["name"]:
+            return values, "farm_name must not be empty"
+        return values, None
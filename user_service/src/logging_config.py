@@ -0,0 +1,142 @@
+"""
+Logging setup shared by the services.
+
+Each service is built from its own Docker context, so this module is copied
+into every service's src/. Keep the copies identical.
+
+Records go through a bounded queue to a background thread that formats and
+writes them, so the MQTT callbacks never wait on log I/O. DEBUG and INFO
+records tagged with an ``esp32_id`` (``extra={"esp32_id": ...}``) can be
+sampled and rate limited per device before they are queued. WARNING and
+above are always kept.
+
+Configured through the environment:
+
+    LOG_LEVEL         root level, default INFO
+    LOG_FORMAT        "text" or "json", default text
+    LOG_SAMPLE_RATE   keep 1 in N DEBUG/INFO records per device, default 1
+    LOG_RATE_LIMIT    max DEBUG/INFO records per device per second, default 0 (off)
+    LOG_QUEUE_SIZE    records buffered before new ones are dropped, default 10000
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including any ``extra`` fields."""
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DeviceSampler(logging.Filter):
+    """Per-device sampling and token bucket rate limiting for DEBUG/INFO records."""
+
+    def __init__(self, sample_rate=1, rate_limit=0.0):
+        super().__init__()
+        self.sample_rate = max(1, sample_rate)
+        self.rate_limit = rate_limit
+        self._counts = {}
+        self._buckets = {}  # esp32_id -> [tokens, last refill]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        esp32_id = getattr(record, "esp32_id", None)
+        if esp32_id is None:
+            return True
+
+        if self.sample_rate > 1:
+            count = self._counts.get(esp32_id, 0)
+            self._counts[esp32_id] = count + 1
+            if count % self.sample_rate:
+                return False
+
+        if self.rate_limit > 0:
+            now = time.monotonic()
+            bucket = self._buckets.get(esp32_id)
+            if bucket is None:
+                bucket = self._buckets[esp32_id] = [self.rate_limit, now]
+            bucket[0] = min(self.rate_limit, bucket[0] + (now - bucket[1]) * self.rate_limit)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queues records without formatting them and drops them when the queue is full.
+
+    Message formatting is left to the listener thread, so objects passed as
+    log arguments must not be changed after the call.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(service):
+    """Routes the root logger through a background writer. Returns the listener."""
+    level = os.getenv("LOG_LEVEL", "INFO").upper()
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        formatter = JsonFormatter(service)
+    else:
+        formatter = logging.Formatter(f"%(asctime)s %(levelname)s {service} %(name)s: %(message)s")
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(formatter)
+
+    handler = DroppingQueueHandler(queue.Queue(int(os.getenv("LOG_QUEUE_SIZE", "10000"))))
+    handler.addFilter(DeviceSampler(
+        sample_rate=int(os.getenv("LOG_SAMPLE_RATE", "1")),
+        rate_limit=float(os.getenv("LOG_RATE_LIMIT", "0")),
+    ))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = QueueListener(handler.queue, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
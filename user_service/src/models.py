@@ -1,5 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
+from sqlalchemy import event
 
 
 db = SQLAlchemy()
@@ -34,4 +35,15 @@ class Farm(db.Model):
     soil_type = db.Column(db.String(50))
     crop_type = db.Column(db.String(50))
     size_unit = db.Column(db.String(20))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
+    @property
+    def etag(self):
+        """Changes whenever the farm does; used for conditional threshold requests."""
+        return f"{self.id}.{self.version}"
+
+
+@event.listens_for(Farm, "before_update")
+def bump_farm_version(mapper, connection, farm):
+    farm.version = (farm.version or 0) + 1
 
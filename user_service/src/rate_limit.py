@@ -0,0 +1,184 @@
+"""
+Admission control for the HTTP APIs.
+
+Each service builds from its own Docker context, so this module is copied
+into every API service's src/. Keep the copies identical.
+
+- Token buckets per client, keyed by JWT identity, then API key, then client
+  address. They live in a memory-mapped file guarded by ``flock``, so every
+  worker process on the host shares the same limits without an external store.
+- A concurrency limit per endpoint class, per process.
+- Requests over a limit are rejected straight away with ``429`` (rate) or
+  ``503`` (concurrency) and a ``Retry-After`` header.
+
+Limits given in code can be overridden per endpoint class through the
+environment, e.g. ``RATE_LIMIT_AUTH=5/10`` (5 requests per second, bursts of
+10) and ``CONCURRENCY_LIMIT_AUTH=4``. ``RATE_LIMIT_ENABLED=false`` turns the
+limiter off and ``RATE_LIMIT_FILE`` moves the shared state file.
+"""
+import fcntl
+import functools
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from logging import getLogger
+
+from flask import Response, request
+from flask_jwt_extended import get_jwt_identity
+
+
+logger = getLogger(__name__)
+
+
+class SharedTokenBuckets:
+    """
+    Fixed-size open addressing table of token buckets in a shared file.
+
+    Each slot holds a 64-bit key hash, the token count and the last refill
+    time. A key is looked for in ``probes`` consecutive slots; when they are
+    all taken by other keys the least recently used one is reused.
+    """
+
+    SLOT = struct.Struct("<Qdd")
+
+    def __init__(self, path, slots=65536, probes=8):
+        self.path = path
+        self.slots = slots
+        self.probes = probes
+        self._pid = None
+        self._file = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1.0):
+        """Takes ``cost`` tokens for ``key``. Returns 0 if allowed, else seconds to wait."""
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+        now = time.time()
+        with self._lock:
+            self._open()
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                offset, tokens, updated = self._find(key_hash)
+                if updated:
+                    tokens = min(burst, tokens + (now - updated) * rate)
+                else:
+                    tokens = burst
+                wait = 0.0
+                if tokens >= cost:
+                    tokens -= cost
+                else:
+                    wait = (cost - tokens) / rate
+                self.SLOT.pack_into(self._map, offset, key_hash, tokens, now)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+        return wait
+
+    def _find(self, key_hash):
+        """Returns (offset, tokens, updated) for the key's slot, or a free/evicted slot with updated=0."""
+        oldest = None
+        start = key_hash % self.slots
+        for probe in range(self.probes):
+            offset = ((start + probe) % self.slots) * self.SLOT.size
+            slot_hash, tokens, updated = self.SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                return offset, tokens, updated
+            if slot_hash == 0:
+                return offset, 0.0, 0.0
+            if oldest is None or updated < oldest[1]:
+                oldest = (offset, updated)
+        return oldest[0], 0.0, 0.0
+
+    def _open(self):
+        # flock is tied to the open file, so every process needs its own descriptor
+        if self._pid == os.getpid():
+            return
+        size = self.slots * self.SLOT.size
+        self._file = open(self.path, "a+b")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._file.fileno()).st_size < size:
+                self._file.truncate(size)
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._pid = os.getpid()
+
+
+def client_identity():
+    """JWT identity if the request carried a verified token, then API key, then client address."""
+    try:
+        identity = get_jwt_identity()
+    except RuntimeError:  # endpoint without @jwt_required
+        identity = None
+    if identity is not None:
+        return f"user:{identity}"
+    api_key = request.headers.get("X-API-KEY")
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    return f"addr:{request.remote_addr}"
+
+
+class RateLimiter:
+    """Per-service limiter. Decorate resource methods with ``limit``."""
+
+    def __init__(self, namespace, path=None):
+        self.namespace = namespace
+        self.enabled = os.getenv("RATE_LIMIT_ENABLED", "true").lower() != "false"
+        path = path or os.getenv("RATE_LIMIT_FILE") or os.path.join(
+            tempfile.gettempdir(), f"{namespace}-rate-limits.bin"
+        )
+        self.buckets = SharedTokenBuckets(path)
+        self._slots = {}  # endpoint class -> semaphore shared by its endpoints
+
+    def limit(self, endpoint_class, rate, burst, concurrency=None, key=None):
+        """
+        Limits a view to ``rate`` requests per second per client, with bursts of
+        ``burst``, and to ``concurrency`` requests in flight per process.
+
+        ``key`` is called with the view's keyword arguments and returns the
+        client identity, for endpoints where ``client_identity`` is too coarse.
+        Put it below ``@jwt_required()`` so the JWT identity is available.
+        """
+        identify = key or (lambda **kwargs: client_identity())
+        name = endpoint_class.upper()
+        if os.getenv(f"RATE_LIMIT_{name}"):
+            rate, burst = (float(part) for part in os.getenv(f"RATE_LIMIT_{name}").split("/"))
+        concurrency = int(os.getenv(f"CONCURRENCY_LIMIT_{name}", concurrency or 0))
+        if concurrency and endpoint_class not in self._slots:
+            self._slots[endpoint_class] = threading.BoundedSemaphore(concurrency)
+        slots = self._slots.get(endpoint_class) if concurrency else None
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+
+                bucket = f"{self.namespace}:{endpoint_class}:{identify(**kwargs)}"
+                wait = self.buckets.take(bucket, rate, burst)
+                if wait:
+                    return {"error": "Too many requests"}, 429, {"Retry-After": str(math.ceil(wait))}
+
+                if slots is None:
+                    return func(*args, **kwargs)
+                if not slots.acquire(blocking=False):
+                    logger.warning("Shedding %s request: %d already in flight", endpoint_class, concurrency)
+                    return {"error": "Service busy, try again shortly"}, 503, {"Retry-After": "1"}
+                try:
+                    result = func(*args, **kwargs)
+                except Exception:
+                    slots.release()
+                    raise
+                if isinstance(result, Response) and result.is_streamed:
+                    # Hold the slot until the streamed body has been sent
+                    result.call_on_close(slots.release)
+                else:
+                    slots.release()
+                return result
+            return wrapper
+        return decorator
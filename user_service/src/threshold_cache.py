@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import Farm
+
+
+class ThresholdCache:
+    """
+    In-process cache of farm thresholds keyed by ``esp32_id``.
+
+    Each entry carries an ETag built from the farm's id and version stamp.
+    Entries are dropped when a transaction that touched the farm commits, so
+    a matching ``If-None-Match`` can be answered without a database query.
+
+    That only reaches the process that committed. Other workers and tasks
+    find out through ``ttl``: an entry is reloaded at most ``ttl`` seconds
+    after it was cached, which bounds how long they serve a stale version.
+    """
+
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._entries = {}  # esp32_id -> (etag, thresholds, expires_at)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        """Bumped on every invalidation. Read it before loading from the DB."""
+        return self._generation
+
+    def get(self, esp32_id):
+        """Returns ``(etag, thresholds)``, or None when missing or expired."""
+        entry = self._entries.get(esp32_id)
+        if entry is None or entry[2] <= time.monotonic():
+            return None
+        return entry[0], entry[1]
+
+    def put(self, esp32_id, etag, thresholds, generation):
+        """Stores an entry unless an invalidation happened since ``generation`` was read."""
+        with self._lock:
+            if generation == self._generation:
+                self._entries[esp32_id] = (etag, thresholds, time.monotonic() + self.ttl)
+
+    def invalidate(self, esp32_ids):
+        with self._lock:
+            self._generation += 1
+            for esp32_id in esp32_ids:
+                self._entries.pop(esp32_id, None)
+
+    def mark_changed(self, session, esp32_ids):
+        """Invalidates ``esp32_ids`` when ``session`` commits.
+
+        For bulk statements, which the flush hooks below do not see.
+        """
+        session.info.setdefault("farm_esp32_ids", set()).update(esp32_ids)
+
+    def register(self):
+        """Hooks cache invalidation into every SQLAlchemy session."""
+        event.listen(Session, "after_flush", self._after_flush)
+        event.listen(Session, "after_commit", self._after_commit)
+        event.listen(Session, "after_rollback", self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        touched = session.info.setdefault("farm_esp32_ids", set())
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Farm):
+                touched.add(obj.esp32_id)
+                # A farm that moved to a new ESP32 must also drop the old entry
+                touched.update(inspect(obj).attrs.esp32_id.history.deleted)
+
+    def _after_commit(self, session):
+        touched = session.info.pop("farm_esp32_ids", None)
+        if touched:
+            self.invalidate(touched)
+
+    def _after_rollback(self, session):
+        session.info.pop("farm_esp32_ids", None)
+
+
+threshold_cache = ThresholdCache(ttl=float(os.getenv("THRESHOLD_CACHE_TTL", "5")))